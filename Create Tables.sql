@@ -16,8 +16,9 @@ CREATE TABLE article (
 
 CREATE TABLE ngram (
 	ngram_id		INT				NOT NULL IDENTITY(1,1),
-	/*Most words are well under 30 characters; this just ensures no words are cut off*/
-	ngram			VARCHAR(30)		NOT NULL, 
+	/*Most words are well under 30 characters; this leaves room for ngrams of up to 3 words
+	  without cutting any off (longer ones are skipped by data-processing.py)*/
+	ngram			VARCHAR(100)	NOT NULL, 
 	article_count	INT				NOT NULL,
 	inv_doc_freq	FLOAT			NOT NULL,
 	CONSTRAINT		pk_ngram		PRIMARY KEY NONCLUSTERED (ngram_id)
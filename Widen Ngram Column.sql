@@ -0,0 +1,10 @@
+USE article_bias;  
+GO
+/*Databases created before multi-word ngrams were supported have a VARCHAR(30) ngram column
+  The clustered index has to be dropped before the column can be widened, then recreated*/
+DROP INDEX ix_ngram ON ngram;
+
+ALTER TABLE ngram ALTER COLUMN ngram VARCHAR(100) NOT NULL;
+
+CREATE UNIQUE CLUSTERED INDEX ix_ngram ON ngram (ngram);
+GO
\ No newline at end of file
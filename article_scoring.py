@@ -0,0 +1,87 @@
+from sklearn.feature_extraction import FeatureHasher
+from scipy.sparse import csr_matrix
+from matrix_store import load_metadata
+from text_processing import process_texts, count_ngrams, augmented_tf
+import numpy as np
+import argparse
+import pickle
+
+# Scores new articles with a trained model without going through the database. The
+# vocabulary, IDF scores and ngram range saved with the training matrix are frozen, so a new
+# article's TF-IDF vector has exactly the same columns and weights the model was trained on
+
+class ArticleScorer:
+    def __init__(self, model, metadata):
+        self.model = model
+        self.idf = np.asarray(metadata["idf"], dtype=np.float64)
+        self.ngram_range = tuple(metadata.get("ngram_range", [1, 1]))
+        self.n_features = metadata["shape"][1]
+        self.classes = {c: source for source, c in metadata["labels"].items()}
+        
+        # without a vocabulary the columns were hashed when the matrix was built
+        self.hasher = None
+        self.columns = None
+        if metadata["vocabulary"] is None:
+            self.hasher = FeatureHasher(n_features=self.n_features, input_type='dict', alternate_sign=False)
+        else:
+            self.columns = {n: i for i, n in enumerate(metadata["vocabulary"])}
+    
+    def vectorize(self, processed_texts):
+        # the augmented TF of every ngram of every document times the ngram's IDF, as one
+        # CSR matrix with a row per document
+        tfs = [augmented_tf(count_ngrams(text, self.ngram_range)) for text in processed_texts]
+        
+        if self.hasher is not None:
+            X = self.hasher.transform(tfs)
+        else:
+            indptr = [0]
+            indices = []
+            data = []
+            columns = self.columns
+            for tf in tfs:
+                for n, value in tf.items():
+                    col = columns.get(n)
+                    if col is not None:
+                        indices.append(col)
+                        data.append(value)
+                indptr.append(len(indices))
+            X = csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int32), np.array(indptr)),
+                           shape=(len(tfs), self.n_features))
+        
+        X.data *= self.idf[X.indices]
+        X.eliminate_zeros()
+        return X
+    
+    def predict(self, texts, processed=False, workers=1):
+        # takes the raw text of the articles (or their processed text if processed=True) and
+        # returns the source each one is predicted to be from
+        if not processed:
+            texts = process_texts(texts, workers=workers)
+        
+        predictions = self.model.predict(self.vectorize(texts))
+        return [self.classes[int(p)] for p in predictions]
+
+def load_scorer(model_path, matrix_path):
+    # model_path is one of the models pickled by model-training.py, and matrix_path the
+    # directory of the matrix it was trained on
+    with open(model_path, "rb") as fp:
+        model = pickle.load(fp)
+    
+    return ArticleScorer(model, load_metadata(matrix_path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict the source of articles saved as text files")
+    parser.add_argument("model", help="a model saved by model-training.py")
+    parser.add_argument("matrix", help="the directory of the matrix the model was trained on")
+    parser.add_argument("files", nargs="+", help="text files holding the raw text of one article each")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to process the text")
+    args = parser.parse_args()
+    
+    scorer = load_scorer(args.model, args.matrix)
+    texts = []
+    for f in args.files:
+        with open(f, "r", encoding='utf-8') as fp:
+            texts.append(fp.read())
+    
+    for f, source in zip(args.files, scorer.predict(texts, workers=args.workers)):
+        print(f, source)
\ No newline at end of file
@@ -0,0 +1,276 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from sqlalchemy import create_engine
+from sqlalchemy.ext.automap import automap_base
+from sqlalchemy.orm import Session
+from bs4 import BeautifulSoup
+from synthetic_corpus import generate_corpus, article_html
+from text_processing import process_texts
+from matrix_store import save_matrix, load_matrix
+import importlib
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import json
+import time
+import sys
+import os
+import numpy as np
+
+# the peak memory of worker processes comes from the operating system's resource usage,
+# which Windows doesn't have
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Times every stage of the pipeline on synthetic articles without the SQL Server database,
+# the news sites or the Windows save path. The articles are served as HTML pages from a
+# local web server, the database is SQLite and everything is written to a temporary folder
+
+# the scripts have hyphens in their names, so they can't be imported with an import statement
+scraping = importlib.import_module("web-scraping")
+processing = importlib.import_module("data-processing")
+training = importlib.import_module("model-training")
+
+# the tables from Create Tables.sql, in SQLite's dialect
+SQLITE_TABLES = [
+    """CREATE TABLE article (
+        article_id      INTEGER         NOT NULL PRIMARY KEY AUTOINCREMENT,
+        source_name     CHAR(6)         NOT NULL,
+        article_url     NVARCHAR(2083)  NOT NULL,
+        raw_text        TEXT            NOT NULL,
+        processed_text  TEXT            NULL,
+        is_training     BIT             NULL
+    )""",
+    """CREATE TABLE ngram (
+        ngram_id        INTEGER         NOT NULL PRIMARY KEY AUTOINCREMENT,
+        ngram           VARCHAR(100)    NOT NULL,
+        article_count   INT             NOT NULL,
+        inv_doc_freq    FLOAT           NOT NULL
+    )""",
+    "CREATE UNIQUE INDEX ix_ngram ON ngram (ngram)",
+    """CREATE TABLE article_ngram (
+        article_id      INT             NOT NULL REFERENCES article(article_id),
+        ngram_id        INT             NOT NULL REFERENCES ngram(ngram_id),
+        term_freq       FLOAT           NOT NULL,
+        tf_idf          FLOAT           NULL,
+        PRIMARY KEY(article_id, ngram_id)
+    )"""
+]
+
+# grid searches for the "small" setting, one cheap grid point for the MLP and two for the SVM
+# so picking the best grid point is still part of the run. "full" uses model-training.py's grids
+SMALL_GRIDS = {"MLP": {"hidden_layer_sizes": [(65,)]},
+               "SVM": {"C": [1, 2**3]}}
+
+class FixtureServer(ThreadingHTTPServer):
+    # the default backlog of 5 connections makes the fetcher's threads wait for
+    # a TCP retransmit whenever more of them connect at once
+    request_queue_size = 128
+    daemon_threads = True
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # serves the pages in the server's pages dictionary, keyed by path
+    def do_GET(self):
+        page = self.server.pages.get(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+        
+        body = page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def serve_fixtures(corpus):
+    # start a local web server with one page per article, returns the server and the
+    # (site, url) of every page in corpus order
+    server = FixtureServer(("127.0.0.1", 0), FixtureHandler)
+    server.pages = {}
+    
+    base = "http://127.0.0.1:" + str(server.server_address[1])
+    links = []
+    for i, (site, text) in enumerate(corpus):
+        path = "/" + site + "/article-" + str(i)
+        server.pages[path] = article_html(site, text)
+        links.append((site, base + path))
+    
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, links
+
+def children_peak():
+    # the largest resident set size of any worker process that has finished so far, in bytes
+    # (Linux reports it in kilobytes, macOS in bytes), or None where it isn't available
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak*1024
+
+def measure(fn):
+    # run fn, returning its result, the wall time, the peak memory allocated by Python in
+    # this process while it ran and the peak resident size of the worker processes it ran
+    # the operating system only keeps the largest worker seen so far, so a stage's workers
+    # are only reported if they grew larger than every earlier stage's, otherwise it's None
+    before = children_peak()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    after = children_peak()
+    workers_peak = after if after is not None and after > before else None
+    return result, elapsed, peak, workers_peak
+
+def scrape(links, workers):
+    # fetch every page with the scraper's fetcher and pull the article text out of it
+    # with the same parser as the scraper. Pages that fail to download are left empty
+    fetcher = scraping.PageFetcher(workers, use_browser=False, delay=0, retries=0)
+    texts = [""] * len(links)
+    try:
+        for i, html in fetcher.fetch([(i, url) for i, (_, url) in enumerate(links)]):
+            if html is None:
+                print("Failed to fetch",links[i][1])
+                continue
+            soup = BeautifulSoup(html, "lxml")
+            texts[i] = scraping.extract_text(links[i][0], soup)
+    finally:
+        fetcher.close()
+    return texts
+
+def create_database(path):
+    engine = create_engine('sqlite:///' + path.replace("\\", "/"))
+    with engine.begin() as connection:
+        for statement in SQLITE_TABLES:
+            connection.exec_driver_sql(statement)
+    return engine
+
+def vectorize(engine, links, raw_texts, processed, matrix_path):
+    # load the articles into the database and run data-processing.py's stages on them
+    Base = automap_base()
+    Base.prepare(engine, reflect=True)
+    Article = Base.classes.article
+    Ngram = Base.classes.ngram
+    Article_Ngram = Base.classes.article_ngram
+    
+    session = Session(engine)
+    session.bulk_insert_mappings(Article, [{"source_name": site, "article_url": url, "raw_text": raw,
+                                            "processed_text": proc, "is_training": 1}
+                                           for (site, url), raw, proc in zip(links, raw_texts, processed)])
+    session.commit()
+    
+    articleTotal = session.query(Article).count()
+    processing.ingest_articles(session, Article, Ngram, Article_Ngram, articleTotal)
+    processing.finalize_tf_idf(session, Ngram, Article_Ngram, articleTotal)
+    X, Y, vocabulary, idf = processing.build_term_document_matrix(session, Article, Ngram, Article_Ngram)
+    save_matrix(matrix_path, X, Y, vocabulary, idf, processing.LABELS)
+    session.close()
+    
+    return X
+
+def cross_validate(folder, matrix_path, num_trials, grids, workers):
+    # run model-training.py's nested cross-validation with an empty result cache
+    X, Y, _ = load_matrix(matrix_path, mmap_mode='r')
+    model_dict = training.make_model_dict(12345, num_trials, grids)
+    for k in model_dict.keys():
+        os.makedirs(os.path.join(folder,k), exist_ok=True)
+    
+    cache = training.ResultCache(os.path.join(folder,"cv_cache.jsonl"), training.data_hash(X, Y))
+    training.run_cross_validation(cache, model_dict, matrix_path, num_trials, folder, workers=workers)
+    
+    return sum(len(model_dict[k]["scores"]) for k in model_dict.keys())
+
+def run_size(n_articles, args):
+    # every stage on a corpus of n_articles, returns a dictionary of measurements per stage
+    corpus = generate_corpus(n_articles, vocabulary_size=args.vocabulary, words_per_article=args.words, seed=args.seed)
+    grids = SMALL_GRIDS if args.cv_grid == "small" else None
+    stages = {}
+    
+    def record(stage, fn, items):
+        result, elapsed, peak, workers_peak = measure(fn)
+        stages[stage] = {"seconds": elapsed, "items": items, "items_per_second": items/elapsed,
+                         "main_peak_bytes": peak, "worker_peak_bytes": workers_peak}
+        workers_mb = "-" if workers_peak is None else "{:.1f}".format(workers_peak/2**20)
+        print("{:>7} articles  {:<10} {:>9.2f} s {:>10.1f} /s {:>9.1f} MB main {:>9} MB largest worker".format(
+              n_articles, stage, elapsed, items/elapsed, peak/2**20, workers_mb))
+        return result
+    
+    server, links = serve_fixtures(corpus)
+    try:
+        raw_texts = record("scrape", lambda: scrape(links, args.fetch_workers), n_articles)
+    finally:
+        server.shutdown()
+        server.server_close()
+    
+    processed = record("text", lambda: process_texts(raw_texts, workers=args.workers), n_articles)
+    
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_database(os.path.join(folder, "article_bias.db"))
+        matrix_path = os.path.join(folder, "matrix")
+        X = record("vectorize", lambda: vectorize(engine, links, raw_texts, processed, matrix_path), n_articles)
+        engine.dispose()
+        stages["vectorize"]["features"] = X.shape[1]
+        stages["vectorize"]["nonzeros"] = int(X.nnz)
+        
+        if args.trials > 0:
+            # the items of the training stage are outer fold test fits, one per model per fold
+            folds = args.trials * training.OUTER_FOLDS * len(SMALL_GRIDS)
+            record("train", lambda: cross_validate(folder, matrix_path, args.trials, grids, args.workers), folds)
+    
+    return stages
+
+def scaling_exponents(sizes, results):
+    # the slope of log(time) against log(corpus size) for every stage, 1 means the stage
+    # scales linearly with the number of articles, 2 quadratically
+    exponents = {}
+    if len(sizes) < 2:
+        return exponents
+    for stage in results[0].keys():
+        seconds = [r[stage]["seconds"] for r in results]
+        exponents[stage] = float(np.polyfit(np.log(sizes), np.log(seconds), 1)[0])
+    return exponents
+
+def main(args):
+    sizes = sorted(args.sizes)
+    results = []
+    for n in sizes:
+        results.append(run_size(n, args))
+    
+    exponents = scaling_exponents(sizes, results)
+    if len(exponents) > 0:
+        print("Scaling exponents (time ~ articles^k):")
+        for stage, k in exponents.items():
+            print("  {:<10} {:.2f}".format(stage, k))
+    
+    if args.output is not None:
+        report = {"settings": {k: v for k, v in vars(args).items() if k != "output"},
+                  "sizes": [{"articles": n, "stages": r} for n, r in zip(sizes, results)],
+                  "scaling_exponents": exponents}
+        with open(args.output, "w", encoding='utf-8') as fp:
+            json.dump(report, fp, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the whole pipeline on synthetic articles")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 500, 1000],
+                        help="corpus sizes to run every stage on")
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=600, help="average words per article")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="processes used for text processing and model training")
+    parser.add_argument("--fetch-workers", type=int, default=scraping.FETCH_WORKERS)
+    parser.add_argument("--trials", type=int, default=1,
+                        help="cross-validation trials to run, 0 skips model training")
+    parser.add_argument("--cv-grid", choices=["small", "full"], default="small")
+    parser.add_argument("--output", help="also write the measurements to this JSON file")
+    args = parser.parse_args()
+    
+    main(args)
\ No newline at end of file
@@ -0,0 +1,79 @@
+from synthetic_corpus import generate_articles
+from text_processing import process_text, process_texts
+import argparse
+import time
+import re
+import os
+
+# Compares the original process_text with the precompiled engine in text_processing.py,
+# first checking that they produce exactly the same output on a synthetic corpus
+
+def legacy_process_text(proc):
+    #the original implementation from web-scraping.py, kept here as the reference
+    #in case the text has this character, make sure it's replaced with a space 
+    #so word boundaries are respected
+    proc = proc.replace("\xa0"," ")
+    
+    #some articles have 2 letter abbreviations separated with periods (a.m., U.S.)
+    #this finds them and removes the periods so they can be considered as n-grams
+    #there is likely a better way of doing this but I tried
+    match = re.findall(r'[A-Za-z]\.[A-Za-z]\.',proc)
+    if(len(match)>0):
+        for m in match:
+            proc = proc.replace(m, m.replace('.',''))
+            
+    #This removes periods from acronyms longer than 2 characters
+    proc = re.sub(r'(?<!\w)([A-Z])\.', '',proc)
+            
+    #This removes numbers and special characters except periods, colons, question marks and spaces
+    proc = re.sub('[^A-Za-z.?: ]+', '', proc)
+    
+    #There is probably a more elegant way of doing this, but this ensures that sentence
+    #boundaries are respected by putting in a space instead (otherwise the words combine)
+    #However this operation can introduce extra whitespace which needs to be removed as well
+    proc = re.sub(r'[.?:]+', " ",proc)
+    proc = re.sub("\s\s+" , " ", proc)
+    proc = proc.strip()
+    
+    #now we convert all the words or ngrams to lower case, unless the ngram is an acronym
+    #then we know it is a different ngram and should be stored in upper case
+    newProc = []
+    for s in proc.split(" "):
+        if(s == s.upper() and len(s) > 1 and len(s) < 6):
+            newProc.append(s)
+        else:
+            newProc.append(s.lower())
+    proc = " ".join(newProc)
+    
+    return proc
+
+def time_it(label, fn, texts, baseline=None):
+    start = time.perf_counter()
+    result = fn(texts)
+    elapsed = time.perf_counter() - start
+    
+    line = "{:<32} {:>8.2f} s {:>10.0f} articles/s".format(label, elapsed, len(texts)/elapsed)
+    if baseline is not None:
+        line += " {:>6.1f}x".format(baseline/elapsed)
+    print(line)
+    
+    return result, elapsed
+
+def main(articles, workers):
+    print("Generating",articles,"articles")
+    texts = generate_articles(articles)
+    
+    expected, baseline = time_it("original (serial)", lambda ts: [legacy_process_text(t) for t in ts], texts)
+    result, _ = time_it("precompiled (serial)", lambda ts: [process_text(t) for t in ts], texts, baseline)
+    assert result == expected, "precompiled output differs from the original"
+    
+    result, _ = time_it("precompiled ("+str(workers)+" processes)", lambda ts: process_texts(ts, workers=workers), texts, baseline)
+    assert result == expected, "batch output differs from the original"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the text normalization")
+    parser.add_argument("--articles", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    
+    main(args.articles, args.workers)
\ No newline at end of file
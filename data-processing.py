@@ -1,15 +1,41 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, cast, Float
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session
 from collections import Counter
+from itertools import islice
+from scipy.sparse import csr_matrix, vstack
+from sklearn.feature_extraction import FeatureHasher
+from matrix_store import save_matrix
+from text_processing import count_ngrams, augmented_tf, NgramEncoder
+from instrumentation import metrics, add_arguments
 import numpy as np
-import pickle
 import os
+import argparse
+import json
+import hashlib
 import traceback
 
-def main():
+# number of articles tokenized and written to the database per round trip
+CHUNK_SIZE = 1000
+
+# dialects that have a LOG10 function, so the IDF update can run entirely in the database
+SQL_LOG10_DIALECTS = {"mssql", "mysql"}
+
+# ngrams need to appear in more than this many articles to be used as a feature
+MIN_ARTICLE_COUNT = 16
+
+# size of the count-min sketch used by the "sketch" prefilter (depth x width 32 bit counters)
+SKETCH_WIDTH = 2**22
+SKETCH_DEPTH = 4
+
+# the class each source is converted to (HuffPo as 1 was completely arbitrary)
+LABELS = {"fox": 0, "huffpo": 1}
+
+def main(rebuild=False, prefilter=None, hash_features=None, ngram_range=(1,1)):
     #create database connection
-    engine = create_engine('mssql://BRIANNA\\SQLEXPRESS/article_bias?trusted_connection=yes&driver=SQL+Server')
+    #fast_executemany lets pyodbc send each bulk insert/update as a single batch
+    engine = create_engine('mssql://BRIANNA\\SQLEXPRESS/article_bias?trusted_connection=yes&driver=SQL+Server', fast_executemany=True)
+    metrics.watch_engine(engine)
     
     #map the database structure onto an object oriented model for simpler processing
     Base = automap_base()
@@ -23,123 +49,481 @@ def main():
     #using this object relational model, create a session with the database
     session = Session(engine)
     
-    allArticles = session.query(Article).all()
-
+    save_path = r'C:\Users\bdardin\Documents\Political Bias Project'
+    
+    #in feature hashing mode the matrix is built straight from the article text, each ngram
+    #is hashed to one of a fixed number of columns, so the ngram tables aren't used at all
+    if hash_features is not None:
+        with metrics.stage("hash"):
+            X, Y, idf = build_hashed_matrix(session, Article, hash_features, ngram_range)
+        with metrics.stage("save"):
+            save_matrix(os.path.join(save_path,"matrix"), X, Y, None, idf, LABELS, ngram_range)
+        return
+    
+    #when rebuilding, throw away the existing vectors so every article is processed again
+    #otherwise only articles without any article_ngram records yet are processed
+    if rebuild:
+        print("Removing existing n-grams")
+        with metrics.stage("rebuild"):
+            session.query(Article_Ngram).delete(synchronize_session=False)
+            session.query(Ngram).delete(synchronize_session=False)
+            session.commit()
+    
     #Save the total number of articles to use in the IDF calculations
-    articleTotal = len(allArticles)
+    articleTotal = session.query(Article).count()
     
-    for i, art in enumerate(allArticles):
-        print("Processing article #",i+1)
-        #Counter produces the array of ngrams along with their frequencies
-        ngrams = Counter(art.processed_text.split(" "))
-        print("Number of n-grams to process:",len(ngrams))
-        #Save the frequency of the most common ngram to use in the augmented TF calculations
-        mostCommon = ngrams.most_common(1)[0][1]
-        a = 0.5
-        
-        for n in ngrams:
-            #Query the database to see if the ngram already exists in the ngram table
-            #one_or_none ensures that if there are no results, it will return as None
-            #then calculate the augmented term frequency for this article/ngram combination
-            sqlN = session.query(Ngram).filter_by(ngram=n).one_or_none()
-            tf = a + a*ngrams[n]/mostCommon
-            
-            if sqlN is None:
-                #if the ngram doesn't exist in the table, then we create a new record
-                #IDF initializes as the log10 of the articleTotal since the ngram has
-                #only appeared in 1 article so far
-                newNGram = Ngram(ngram=n, article_count=1, inv_doc_freq=np.log10(articleTotal))
-                session.add(newNGram)
-                session.commit()
-                
-                #after saving the record to the database, we query for it to grab its ID
-                #then we can create the article_ngram record
-                addedNGram = session.query(Ngram).filter_by(ngram=n).one_or_none()
-                artNGram = Article_Ngram(article_id=art.article_id, ngram_id=addedNGram.ngram_id, term_freq=tf)
-                session.add(artNGram)
+    #most ngrams never appear in enough articles to be used as features, so with a prefilter
+    #their document frequencies are counted first and only the ones that can make the cut
+    #are stored. Once the vocabulary has been built this way it stays fixed for incremental
+    #runs, since the earlier articles' counts of any other ngram were never stored. Those
+    #counts are kept in a count-min sketch instead (document_frequencies.npy), so an ngram
+    #that starts showing up in enough new articles is noticed and a --rebuild can add it
+    #counting every multi-word ngram would blow up the ngram tables, so they always get one
+    if prefilter is None and ngram_range[1] > 1:
+        prefilter = "exact"
+    
+    #how the vocabulary was built is saved alongside it, so incremental runs keep building it
+    #the same way. A vocabulary built without a prefilter holds every ngram's count, so it
+    #can't be frozen part way through, that takes a --rebuild
+    settings_path = os.path.join(save_path,"vocabulary.json")
+    frequencies_path = os.path.join(save_path,"document_frequencies.npy")
+    keep = None
+    frequencies = None
+    missed = set()
+    if session.query(Ngram).first() is None:
+        save_vocabulary_settings(settings_path, prefilter, ngram_range)
+        if prefilter is not None:
+            frequencies = CountMinSketch(SKETCH_WIDTH, SKETCH_DEPTH)
+            with metrics.stage("prefilter"):
+                keep = count_document_frequencies(session, Article, sketch=(prefilter == "sketch"), ngram_range=ngram_range)
+    else:
+        built_with, built_range = load_vocabulary_settings(settings_path)
+        if built_range != ngram_range:
+            print("The vocabulary was built with an ngram range of",built_range,"use --rebuild to change it")
+            return
+        if built_with is None and prefilter is not None:
+            print("The vocabulary was built without a prefilter, use --rebuild to build it with one")
+            return
+        if built_with is not None:
+            if os.path.exists(frequencies_path):
+                frequencies = CountMinSketch.load(frequencies_path)
             else:
-                #if the ngram is already in the ngram table, then we update the article_count
-                #and then recalculate the IDF with the new count
-                sqlN.article_count = sqlN.article_count + 1
-                sqlN.inv_doc_freq = np.log10(articleTotal/sqlN.article_count)
-                
-                #then we also create a new article_ngram record in the same way as above
-                artNGram = Article_Ngram(article_id=art.article_id, ngram_id=sqlN.ngram_id, term_freq=tf)
-                session.add(artNGram)
+                print("No document frequencies were saved with the vocabulary, only new articles will be counted")
+                frequencies = CountMinSketch(SKETCH_WIDTH, SKETCH_DEPTH)
+            
+            #nothing new is stored, but the ngrams that now appear in enough articles are noted
+            def keep(ngrams):
+                estimates = frequencies.estimate(ngrams)
+                missed.update(n for n, count in zip(ngrams, estimates) if count > MIN_ARTICLE_COUNT)
+                return [False] * len(ngrams)
     
-    #if there are any leftover records in the session that weren't committed when the ngrams
-    #were committed, this will insert them all
-    session.commit()
-        
-    #now that all the ngrams have their final IDF scores, we are ready to calculate the TF-IDF scores
-    #this query grabs all the article_ngram records and their associated ngram record
-    artNGrams = session.query(Ngram, Article_Ngram).join(Article_Ngram, Ngram.ngram_id == Article_Ngram.ngram_id).all()
+    #build the vocabulary and the article_ngram records a chunk of articles at a time
+    #so the number of round trips depends on the number of chunks, not the number of tokens
+    with metrics.stage("ingest"):
+        newArticles = ingest_articles(session, Article, Ngram, Article_Ngram, articleTotal, keep=keep, ngram_range=ngram_range,
+                                      frequencies=frequencies, frequencies_path=frequencies_path)
+    print("Vectorized",newArticles,"new articles")
+    
+    #the sketch can overestimate, so this can be a false alarm, but never misses an ngram
+    metrics.add("missed_ngrams", len(missed))
+    if len(missed) > 0:
+        print(len(missed),"ngrams outside the vocabulary may now appear in more than",MIN_ARTICLE_COUNT,
+              "articles, run data-processing.py --rebuild to add them")
     
-    #here we simply iterate over all the article_ngram records and calculate its TF-IDF
-    #the query returns result objects which are tuples of the article_ngram and ngram records
-    #which is why the referencing here is unintuitive
-    for ang in artNGrams:
-        ang[1].tf_idf = ang[1].term_freq * ang[0].inv_doc_freq
+    #if nothing new was scraped (and an earlier run didn't stop before finishing its
+    #TF-IDF scores) the scores and the matrix are already up to date
+    unscored = session.query(Article_Ngram).filter(Article_Ngram.tf_idf == None).first()
+    if newArticles == 0 and unscored is None:
+        return
     
-    #all of the changes above are saved by the session so they can be committed all at once
-    session.commit()
+    #now that every ngram has its final article count, recompute the IDF scores and use them
+    #to calculate the TF-IDF scores, all inside the database
+    #the article total changes every IDF, so this covers the existing articles as well, but
+    #none of their text has to be processed again
+    with metrics.stage("finalize"):
+        finalize_tf_idf(session, Ngram, Article_Ngram, articleTotal)
     
+    #build the sparse term-document matrix from the TF-IDF scores of the ngrams that appear
+    #in enough articles, along with the class of each article
+    with metrics.stage("matrix"):
+        X, Y, vocabulary, idf = build_term_document_matrix(session, Article, Ngram, Article_Ngram)
+        metrics.add("nonzeros", X.nnz)
+    
+    # store the data in a format model-training.py can memory map for easy retrieval
+    with metrics.stage("save"):
+        save_matrix(os.path.join(save_path,"matrix"), X, Y, vocabulary, idf, LABELS, ngram_range)
+
+def save_vocabulary_settings(path, prefilter, ngram_range):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding='utf-8') as fp:
+        json.dump({"prefilter": prefilter, "ngram_range": list(ngram_range)}, fp)
+
+def load_vocabulary_settings(path):
+    # returns the prefilter and ngram range the vocabulary was built with
+    # vocabularies built before the settings were saved had neither
+    if not os.path.exists(path):
+        return None, (1,1)
+    with open(path, "r", encoding='utf-8') as fp:
+        settings = json.load(fp)
+    return settings["prefilter"], tuple(settings["ngram_range"])
+
+def build_term_document_matrix(session, Article, Ngram, Article_Ngram, chunk_size=CHUNK_SIZE*100):
     # query all the ngram ids to be used in creating the term-document matrix
-    # the id will correspond to the column or dimension
-    ngram_ids = []
-    for val in session.query(Ngram.ngram_id).filter(Ngram.article_count>16).distinct():
-         ngram_ids.append(val[0])
+    # the id will correspond to the column or dimension, and they are kept in order
+    # for consistency between articles. The ngrams and their IDF scores are saved with
+    # the matrix so new articles can be scored against the same columns
+    features = session.query(Ngram.ngram_id, Ngram.ngram, Ngram.inv_doc_freq) \
+                      .filter(Ngram.article_count>MIN_ARTICLE_COUNT) \
+                      .order_by(Ngram.ngram_id).all()
+    ngram_ids = np.array([f[0] for f in features], dtype=np.int64)
+    vocabulary = [f[1] for f in features]
+    idf = np.array([f[2] for f in features], dtype=np.float64)
     
-    # make sure the ids are in order for consistency between articles     
-    ngram_ids.sort()
+    #Query the ID and source of all the articles, each article is one row of the matrix
+    #converts the source name into either 0 or 1. 
+    #The choice of HuffPo as 1 here was completely arbitrary
+    articles = session.query(Article.article_id, Article.source_name).order_by(Article.article_id).all()
+    article_ids = np.array([art[0] for art in articles], dtype=np.int64)
+    Y = np.array([int(art[1] == 'huffpo') for art in articles])
     
-    #Query all the articles
-    allArticles = session.query(Article).all()
+    # lookup arrays indexed by ID give the column/row of an ngram/article in O(1)
+    # IDs that aren't part of the matrix map to -1
+    col_lookup = np.full(ngram_ids.max()+1 if len(ngram_ids) > 0 else 0, -1, dtype=np.int64)
+    col_lookup[ngram_ids] = np.arange(len(ngram_ids))
+    row_lookup = np.full(article_ids.max()+1 if len(article_ids) > 0 else 0, -1, dtype=np.int64)
+    row_lookup[article_ids] = np.arange(len(article_ids))
     
-    #Prepare X and Y arrays
-    X = []
+    # stream every qualifying (article_id, ngram_id, tf_idf) triple in a single query
+    # and convert them to matrix coordinates a batch at a time
+    triples = iter(session.query(Article_Ngram.article_id, Article_Ngram.ngram_id, Article_Ngram.tf_idf) \
+                          .join(Ngram, Ngram.ngram_id == Article_Ngram.ngram_id) \
+                          .filter(Ngram.article_count>MIN_ARTICLE_COUNT) \
+                          .yield_per(chunk_size))
+    rows, cols, data = [], [], []
+    while True:
+        batch = list(islice(triples, chunk_size))
+        if len(batch) == 0:
+            break
+        
+        batch = np.array(batch, dtype=np.float64)
+        rows.append(row_lookup[batch[:,0].astype(np.int64)])
+        cols.append(col_lookup[batch[:,1].astype(np.int64)])
+        data.append(batch[:,2])
+        print("Loaded",sum(len(d) for d in data),"TF-IDF scores")
+    
+    # most of the matrix is zeros so it is stored in compressed sparse row format
+    # which both models can train on directly
+    if len(data) > 0:
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+    X = csr_matrix((data, (rows, cols)), shape=(len(article_ids), len(ngram_ids)))
+    
+    return X, Y, vocabulary, idf
+
+def build_hashed_matrix(session, Article, n_features, ngram_range=(1,1), chunk_size=CHUNK_SIZE):
+    # each article's augmented term frequencies are hashed into n_features columns, so there
+    # is no vocabulary to store and the width of the matrix is fixed ahead of time
+    # colliding ngrams simply add up in the same column
+    hasher = FeatureHasher(n_features=n_features, input_type='dict', alternate_sign=False)
+    
+    blocks = []
     Y = []
+    for c, chunk in enumerate(iter_article_chunks(session, Article, chunk_size, columns=[Article.source_name])):
+        print("Hashing chunk #",c+1,"(",len(chunk),"articles )")
+        tfs = [augmented_tf(count_ngrams(text, ngram_range)) if text is not None else {} for _, text, _ in chunk]
+        blocks.append(hasher.transform(tfs))
+        Y.extend(int(source == 'huffpo') for _, _, source in chunk)
+    
+    X = vstack(blocks, format='csr') if len(blocks) > 0 else csr_matrix((0, n_features))
+    Y = np.array(Y)
     
-    for art in allArticles:
-        #converts the source name into either 0 or 1. 
-        #The choice of HuffPo as 1 here was completely arbitrary
-        Y_class = int(art.source_name == 'huffpo')
+    # the document frequency of each column is the number of rows it is nonzero in
+    # columns that don't appear in enough articles get an IDF of 0 and are dropped
+    df = np.bincount(X.indices, minlength=n_features)
+    idf = np.zeros(n_features)
+    features = df > MIN_ARTICLE_COUNT
+    idf[features] = np.log10(X.shape[0]/df[features])
+    
+    X.data *= idf[X.indices]
+    X.eliminate_zeros()
+    
+    return X, Y, idf
+
+def count_document_frequencies(session, Article, sketch=False, ngram_range=(1,1), chunk_size=CHUNK_SIZE):
+    # stream through every article and count how many articles each ngram appears in, either
+    # exactly or with a count-min sketch that takes a fixed amount of memory no matter how big
+    # the vocabulary is. Returns a function telling which of a list of ngrams appear in more
+    # than MIN_ARTICLE_COUNT articles, and so are worth storing
+    if sketch:
+        # the sketch can overestimate but never underestimates, so every ngram that really
+        # makes the cut is kept, plus a few that get weeded out by the matrix's own filter
+        counts = CountMinSketch(SKETCH_WIDTH, SKETCH_DEPTH)
+        for c, chunk in enumerate(iter_article_chunks(session, Article, chunk_size)):
+            print("Counting chunk #",c+1,"(",len(chunk),"articles )")
+            chunk_freq = Counter()
+            for _, text in chunk:
+                if text is not None:
+                    chunk_freq.update(count_ngrams(text, ngram_range).keys())
+            counts.update(chunk_freq)
         
-        #Query all the article_ngram records associated with this article
-        artNGrams = session.query(Article_Ngram) \
-                    .filter_by(article_id=art.article_id) \
-                    .join(Ngram, Ngram.ngram_id == Article_Ngram.ngram_id) \
-                    .filter(Ngram.article_count>16).all()
+        return lambda ngrams: counts.estimate(ngrams) > MIN_ARTICLE_COUNT
+    
+    # exact counts are done one ngram length at a time, with the words encoded as integers
+    # and each ngram packed into a single integer key. An ngram can't appear in more articles
+    # than the (n-1)-grams it starts and ends with, so only ngrams made of two frequent
+    # (n-1)-grams are counted at all, and everything else is pruned before it is stored
+    encoder = NgramEncoder()
+    keep = set()
+    frequent = None
+    for n in range(1, ngram_range[1]+1):
+        counts = Counter()
+        for c, chunk in enumerate(iter_article_chunks(session, Article, chunk_size)):
+            print("Counting",n,"-grams in chunk #",c+1,"(",len(chunk),"articles )")
+            chunk_freq = Counter()
+            for _, text in chunk:
+                if text is None:
+                    continue
+                ids = encoder.encode(text.split(" "))
+                grams = set()
+                for i in range(len(ids)-n+1):
+                    if n > 1 and (encoder.pack(ids[i:i+n-1]) not in frequent or encoder.pack(ids[i+1:i+n]) not in frequent):
+                        continue
+                    grams.add(encoder.pack(ids[i:i+n]))
+                chunk_freq.update(grams)
+            counts.update(chunk_freq)
         
-        #initialize a zero vector with ngram_ids dimensions
-        X_vector = [0] * len(ngram_ids)
+        frequent = set(key for key, count in counts.items() if count > MIN_ARTICLE_COUNT)
+        print("Keeping",len(frequent),"of",len(counts),n,"-grams")
+        if n >= ngram_range[0]:
+            keep.update(encoder.decode(key) for key in frequent)
+    
+    return lambda ngrams: [n in keep for n in ngrams]
+
+class CountMinSketch:
+    # approximate counts in a fixed depth x width table. Each key is counted in one cell of
+    # every row and its estimate is the smallest of those cells, which can only be too high
+    # when other keys collide with it in every row
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+    
+    def columns(self, keys):
+        # double hashing: row r uses h1 + r*h2, from one stable 128 bit hash per key
+        h1 = np.empty(len(keys), dtype=np.uint64)
+        h2 = np.empty(len(keys), dtype=np.uint64)
+        for i, key in enumerate(keys):
+            digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+            h1[i] = int.from_bytes(digest[:8], 'little')
+            h2[i] = int.from_bytes(digest[8:], 'little') | 1
         
-        #use the ngram_id to update the corresponding index in X_vector with its TF-IDF score
-        for ang in artNGrams:
-            idx = ngram_ids.index(ang.ngram_id)
-            X_vector[idx] = ang.tf_idf
+        rows = np.arange(self.depth, dtype=np.uint64)[:,None]
+        return ((h1[None,:] + rows*h2[None,:]) % np.uint64(self.width)).astype(np.int64)
+    
+    def update(self, counts):
+        # counts maps keys to how much to add to each of them
+        # a conservative update only raises a key's cells as far as its new estimate, instead
+        # of adding to all of them, which still never underestimates but collides far less
+        keys = list(counts.keys())
+        if len(keys) == 0:
+            return
+        values = np.array([counts[k] for k in keys], dtype=np.uint32)
+        cols = self.columns(keys)
+        targets = self.table[np.arange(self.depth)[:,None], cols].min(axis=0) + values
+        for r in range(self.depth):
+            np.maximum.at(self.table[r], cols[r], targets)
+    
+    def estimate(self, keys):
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        cols = self.columns(keys)
+        return self.table[np.arange(self.depth)[:,None], cols].min(axis=0)
+    
+    def save(self, path):
+        # written to a temporary file first, so a crash never leaves half a table behind
+        with open(path + ".tmp", "wb") as fp:
+            np.save(fp, self.table)
+        os.replace(path + ".tmp", path)
+    
+    @classmethod
+    def load(cls, path):
+        sketch = cls(1, 1)
+        sketch.table = np.load(path)
+        sketch.depth, sketch.width = sketch.table.shape
+        return sketch
+
+def iter_article_chunks(session, Article, chunk_size=CHUNK_SIZE, *criteria, columns=()):
+    # page through the articles in article_id order, only pulling the columns we need
+    # (the ID, the processed text and any extra columns asked for)
+    # keyset paging (article_id > last seen id) keeps every page an index seek
+    last_id = 0
+    while True:
+        chunk = session.query(Article.article_id, Article.processed_text, *columns) \
+                .filter(Article.article_id > last_id, *criteria) \
+                .order_by(Article.article_id) \
+                .limit(chunk_size).all()
+        if len(chunk) == 0:
+            break
         
-        #update the appropriate arrays    
-        Y.append(Y_class)
-        X.append(X_vector)
+        yield chunk
+        last_id = chunk[-1][0]
+
+def ingest_articles(session, Article, Ngram, Article_Ngram, articleTotal, chunk_size=CHUNK_SIZE, keep=None, ngram_range=(1,1),
+                    frequencies=None, frequencies_path=None):
+    # keep, if given, decides which ngrams that aren't in the vocabulary yet get stored
+    # frequencies, if given, is a count-min sketch the document frequencies of those ngrams
+    # are added to before keep is asked about them, saved to frequencies_path after every chunk
+    # ngrams longer than the ngram column can't be stored, so they are skipped too
+    max_length = Ngram.__table__.c.ngram.type.length
     
-    # convert to numpy arrays so they can be used as inputs for the models
-    X = np.array(X)
-    Y = np.array(Y)
+    # only articles that don't have any article_ngram records yet are processed, and every
+    # chunk is committed along with its article_count updates, so an interrupted run
+    # picks up where it left off
+    unprocessed = ~session.query(Article_Ngram).filter(Article_Ngram.article_id == Article.article_id).exists()
     
-    save_path = r'C:\Users\bdardin\Documents\Political Bias Project'
+    # the vocabulary maps each ngram to [ngram_id, article_count] so the ngram table
+    # never has to be queried once per token. Any ngrams already in the table are
+    # loaded first so they are updated instead of duplicated
+    vocab = {}
+    max_id = 0
+    for n, ngram_id, count in session.query(Ngram.ngram, Ngram.ngram_id, Ngram.article_count):
+        vocab[n] = [ngram_id, count]
+        max_id = max(max_id, ngram_id)
     
-    # pickle or store the data for easy retrieval    
-    with open(os.path.join(save_path,"x.txt"), "wb") as fp:
-        pickle.dump(X, fp)
+    processed = 0
+    for c, chunk in enumerate(iter_article_chunks(session, Article, chunk_size, unprocessed)):
+        print("Processing chunk #",c+1,"(",len(chunk),"articles )")
         
-    with open(os.path.join(save_path,"y.txt"), "wb") as fp:
-        pickle.dump(Y, fp)
+        #Counter produces the array of ngrams along with their frequencies
+        #chunk_freq counts how many articles in this chunk each ngram appears in
+        article_ngrams = []
+        chunk_freq = Counter()
+        with metrics.stage("tokenize"):
+            for article_id, text in chunk:
+                if text is None:
+                    continue
+                #the term frequencies are calculated before any ngrams are dropped, so the
+                #article's most common ngram is the same with or without a prefilter
+                tfs = augmented_tf(count_ngrams(text, ngram_range))
+                article_ngrams.append((article_id, tfs))
+                chunk_freq.update(tfs.keys())
+        
+        #drop the new ngrams that won't appear in enough articles to be kept
+        if max_length is not None:
+            for n in [n for n in chunk_freq if len(n) > max_length]:
+                del chunk_freq[n]
+        if keep is not None:
+            new = [n for n in chunk_freq if n not in vocab]
+            if frequencies is not None:
+                frequencies.update({n: chunk_freq[n] for n in new})
+            for n, kept in zip(new, keep(new)):
+                if not kept:
+                    del chunk_freq[n]
+        
+        #split the chunk's ngrams into ones we have never seen and ones that only need
+        #their article_count bumped, then write each group with a single bulk statement
+        #the IDF written here is provisional, the final value is set once every article is counted
+        new_ngrams = []
+        updated_ngrams = []
+        for n, count in chunk_freq.items():
+            if n in vocab:
+                vocab[n][1] += count
+                updated_ngrams.append({"ngram_id": vocab[n][0], "article_count": vocab[n][1]})
+            else:
+                new_ngrams.append({"ngram": n, "article_count": count, "inv_doc_freq": np.log10(articleTotal/count)})
+        
+        with metrics.stage("write ngrams"):
+            session.bulk_insert_mappings(Ngram, new_ngrams)
+            session.bulk_update_mappings(Ngram, updated_ngrams)
+            
+            #the IDs of the ngrams we just inserted are the only ones above the previous maximum
+            #so one query picks them all up
+            if len(new_ngrams) > 0:
+                for n, ngram_id, count in session.query(Ngram.ngram, Ngram.ngram_id, Ngram.article_count) \
+                                                .filter(Ngram.ngram_id > max_id):
+                    vocab[n] = [ngram_id, count]
+                    max_id = max(max_id, ngram_id)
+        
+        #save the augmented term frequency for every article/ngram combination in the chunk
+        rows = []
+        for article_id, tfs in article_ngrams:
+            for n, tf in tfs.items():
+                if n in vocab:
+                    rows.append({"article_id": article_id, "ngram_id": vocab[n][0], "term_freq": tf})
+        
+        with metrics.stage("write article ngrams"):
+            session.bulk_insert_mappings(Article_Ngram, rows)
+            session.commit()
+        if frequencies is not None:
+            frequencies.save(frequencies_path)
+        processed += len(article_ngrams)
+        metrics.add("articles", len(article_ngrams))
+        metrics.add("new_ngrams", len(new_ngrams))
+    
+    return processed
+
+def finalize_tf_idf(session, Ngram, Article_Ngram, articleTotal, chunk_size=CHUNK_SIZE):
+    # first recompute every ngram's IDF from its final article count
+    # where the database has a LOG10 function this is a single UPDATE, otherwise the counts
+    # are read a chunk at a time and the logs are taken with numpy
+    with metrics.stage("idf"):
+        if session.bind.dialect.name in SQL_LOG10_DIALECTS:
+            session.query(Ngram).update({Ngram.inv_doc_freq: func.log10(cast(articleTotal, Float) / Ngram.article_count)},
+                                        synchronize_session=False)
+        else:
+            last_id = 0
+            while True:
+                rows = session.query(Ngram.ngram_id, Ngram.article_count) \
+                       .filter(Ngram.ngram_id > last_id) \
+                       .order_by(Ngram.ngram_id) \
+                       .limit(chunk_size*10).all()
+                if len(rows) == 0:
+                    break
+                
+                ids, counts = np.array(rows).T
+                idf = np.log10(articleTotal/counts)
+                session.bulk_update_mappings(Ngram, [{"ngram_id": int(i), "inv_doc_freq": float(v)} for i, v in zip(ids, idf)])
+                last_id = rows[-1][0]
+        session.commit()
+    
+    # then set tf_idf = term_freq * inv_doc_freq with a correlated UPDATE, one range of
+    # article IDs at a time so no single statement has to log the whole table
+    idf = session.query(Ngram.inv_doc_freq) \
+          .filter(Ngram.ngram_id == Article_Ngram.ngram_id) \
+          .correlate(Article_Ngram).as_scalar()
+    max_id = session.query(func.max(Article_Ngram.article_id)).scalar() or 0
+    
+    for start in range(0, max_id, chunk_size):
+        print("Calculating TF-IDF for articles",start+1,"to",min(start+chunk_size, max_id))
+        with metrics.stage("tf-idf"):
+            session.query(Article_Ngram) \
+                   .filter(Article_Ngram.article_id > start, Article_Ngram.article_id <= start+chunk_size) \
+                   .update({Article_Ngram.tf_idf: Article_Ngram.term_freq * idf}, synchronize_session=False)
+            session.commit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculate the TF-IDF scores and build the term-document matrix")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="re-vectorize every article instead of only the newly scraped ones")
+    parser.add_argument("--prefilter", choices=["exact", "sketch"],
+                        help="count document frequencies first and only store ngrams that can be features "
+                             "(a vocabulary built with a prefilter stays fixed on later runs, adding one "
+                             "to an existing vocabulary needs --rebuild)")
+    parser.add_argument("--hash-features", type=int, metavar="N",
+                        help="hash the ngrams into N columns instead of building a vocabulary")
+    parser.add_argument("--ngram-range", type=int, nargs=2, default=[1, 1], metavar=("MIN", "MAX"),
+                        help="count ngrams of MIN to MAX words (ranges above 1 always use a prefilter), "
+                             "incremental runs need the same range the vocabulary was built with")
+    add_arguments(parser)
+    args = parser.parse_args()
+    
     # wrap the program in a try/except block in case there are errors
+    # the metrics and profile are written even if the run fails part way through
+    metrics.start(profile=args.profile is not None, trace_memory=args.trace_memory)
     try:
-        main()
+        main(rebuild=args.rebuild, prefilter=args.prefilter, hash_features=args.hash_features,
+             ngram_range=tuple(args.ngram_range))
     except Exception as e:
         print(e)
-        print(traceback.format_exc())
\ No newline at end of file
+        print(traceback.format_exc())
+    finally:
+        metrics.finish(args.metrics, args.profile)
\ No newline at end of file
@@ -0,0 +1,160 @@
+from sqlalchemy import event
+from contextlib import contextmanager
+import cProfile
+import threading
+import tracemalloc
+import json
+import time
+import os
+
+# Records where a run spends its time. Code is wrapped in named stages, and every stage
+# keeps its number of calls, total wall time, any counts added while it was running (pages
+# fetched, fits completed, ...) and the number of SQL statements and rows written by any
+# engine being watched. Stages can be nested, a nested stage is reported under its parent's
+# name ("ingest/write") and its time and counts are included in the parent's as well.
+# Stages are kept per thread, so worker threads can time their own work.
+# The totals can be written out as JSON, and the whole run can be profiled with cProfile.
+
+class Instrumentation:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.started = time.time()
+        self.start_time = time.perf_counter()
+        self.profiler = None
+        self.trace_memory = False
+    
+    def stack(self):
+        # the names of the stages the current thread is in, outermost first
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+    
+    def record(self, name):
+        # the totals of a stage, created the first time it is used
+        # must be called with the lock held
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"calls": 0, "seconds": 0.0, "statements": 0, "rows_written": 0, "counts": {}}
+        return stage
+    
+    def track_peak(self):
+        # with memory tracing on, the peak since the last stage started or ended counts
+        # towards every stage that is open, then the peak starts over
+        peak = tracemalloc.get_traced_memory()[1]
+        for name in self.stack():
+            stage = self.record(name)
+            stage["peak_bytes"] = max(stage.get("peak_bytes", 0), peak)
+        tracemalloc.reset_peak()
+    
+    @contextmanager
+    def stage(self, name):
+        stack = self.stack()
+        if len(stack) > 0:
+            name = stack[-1] + "/" + name
+        
+        with self.lock:
+            if self.trace_memory:
+                self.track_peak()
+            self.record(name)["calls"] += 1
+        stack.append(name)
+        
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                if self.trace_memory:
+                    self.track_peak()
+                self.record(name)["seconds"] += elapsed
+            stack.pop()
+    
+    def add(self, counter, n=1):
+        # add n to a counter of every stage the current thread is in
+        # outside of any stage it is only counted in the totals of the run
+        with self.lock:
+            for name in self.stack() or ["total"]:
+                counts = self.record(name)["counts"]
+                counts[counter] = counts.get(counter, 0) + n
+    
+    def add_time(self, name, seconds, calls=1):
+        # time spent somewhere this object can't see, like a worker process, is added to a
+        # stage of its own (nested under the current stage) instead of being timed directly
+        stack = self.stack()
+        if len(stack) > 0:
+            name = stack[-1] + "/" + name
+        
+        with self.lock:
+            stage = self.record(name)
+            stage["calls"] += calls
+            stage["seconds"] += seconds
+    
+    def add_statement(self, rows):
+        with self.lock:
+            for name in self.stack() or ["total"]:
+                stage = self.record(name)
+                stage["statements"] += 1
+                stage["rows_written"] += rows
+    
+    def watch_engine(self, engine):
+        # count every statement the engine sends, and the rows written by INSERTs, UPDATEs
+        # and DELETEs. Bulk statements sent with executemany count every parameter set as a
+        # row, since pyodbc's fast_executemany doesn't report a row count for them
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            rows = 0
+            if statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+                if executemany:
+                    rows = len(parameters)
+                elif cursor.rowcount is not None and cursor.rowcount > 0:
+                    rows = cursor.rowcount
+            self.add_statement(rows)
+    
+    def start(self, profile=False, trace_memory=False):
+        # profiling only sees the main thread, the fetcher's threads and the training
+        # processes show up as time spent waiting for them
+        if trace_memory:
+            tracemalloc.start()
+            self.trace_memory = True
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+    
+    def report(self):
+        with self.lock:
+            stages = {name: dict(stage, counts=dict(stage["counts"])) for name, stage in self.stages.items()}
+        return {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "wall_seconds": time.perf_counter() - self.start_time,
+                "pid": os.getpid(),
+                "stages": stages}
+    
+    def finish(self, metrics_path=None, profile_path=None):
+        # write the stage totals as JSON and the profile in pstats format
+        if self.profiler is not None:
+            self.profiler.disable()
+            if profile_path is not None:
+                self.profiler.dump_stats(profile_path)
+            self.profiler = None
+        
+        if metrics_path is not None:
+            with open(metrics_path, "w", encoding='utf-8') as fp:
+                json.dump(self.report(), fp, indent=2)
+        
+        if self.trace_memory:
+            tracemalloc.stop()
+            self.trace_memory = False
+
+# every script records into this one
+metrics = Instrumentation()
+
+def add_arguments(parser):
+    # the command line options every script uses to turn on the outputs
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write the time, SQL statements and counts of every stage to this JSON file")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="profile the run with cProfile and write the stats to this file")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the peak memory allocated during every stage (slows the run down)")
\ No newline at end of file
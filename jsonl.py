@@ -0,0 +1,36 @@
+import json
+import os
+
+# The caches and indexes are JSON lines files that are appended to one entry at a time, so a
+# crash can only ever damage the last line. Reading drops a last line that was cut short (and
+# truncates it from the file, so the next entry starts on a line of its own), and writing
+# flushes every entry to disk before returning
+
+def read_entries(path):
+    # every entry of the file, in order, or an empty list if it doesn't exist yet
+    if not os.path.exists(path):
+        return []
+    
+    with open(path, "rb") as fp:
+        data = fp.read()
+    
+    end = data.rfind(b"\n") + 1
+    if end < len(data):
+        print("Dropping an incomplete last line from",path)
+        with open(path, "r+b") as fp:
+            fp.truncate(end)
+    
+    entries = []
+    for line in data[:end].splitlines():
+        if line.strip():
+            try:
+                entries.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                print("Skipping an unreadable line in",path)
+    return entries
+
+def append_entry(path, entry):
+    with open(path, "a", encoding='utf-8') as fp:
+        fp.write(json.dumps(entry)+"\n")
+        fp.flush()
+        os.fsync(fp.fileno())
\ No newline at end of file
@@ -0,0 +1,59 @@
+from scipy.sparse import csr_matrix
+import numpy as np
+import json
+import os
+
+# The term-document matrix is stored as a directory holding the CSR component arrays,
+# the labels and the IDF vector as .npy files, plus a small JSON header with the shape,
+# vocabulary and label mapping. Plain .npy files can be opened with mmap_mode, so every
+# process that loads the matrix shares the same pages instead of holding its own copy.
+
+ARRAYS = ["data", "indices", "indptr", "y", "idf"]
+
+def save_matrix(path, X, Y, vocabulary, idf, labels, ngram_range=(1,1)):
+    os.makedirs(path, exist_ok=True)
+    
+    # make sure we are writing a canonical CSR matrix
+    X = csr_matrix(X)
+    X.sum_duplicates()
+    X.sort_indices()
+    
+    arrays = {"data": X.data,
+              "indices": X.indices,
+              "indptr": X.indptr,
+              "y": np.asarray(Y),
+              "idf": np.asarray(idf, dtype=np.float64)}
+    for name in ARRAYS:
+        np.save(os.path.join(path, name+".npy"), arrays[name])
+    
+    # vocabulary is the ngram for each column in order (or None if the columns are hashed),
+    # labels maps each source name to its class and ngram_range is the range of ngram lengths
+    metadata = {"shape": list(X.shape),
+                "vocabulary": vocabulary,
+                "labels": labels,
+                "ngram_range": list(ngram_range)}
+    with open(os.path.join(path, "metadata.json"), "w", encoding='utf-8') as fp:
+        json.dump(metadata, fp)
+
+def load_metadata(path):
+    # just the header and the IDF vector, for when the matrix itself isn't needed
+    with open(os.path.join(path, "metadata.json"), "r", encoding='utf-8') as fp:
+        metadata = json.load(fp)
+    metadata["idf"] = np.load(os.path.join(path, "idf.npy"))
+    
+    return metadata
+
+def load_matrix(path, mmap_mode=None):
+    # with mmap_mode='r' nothing is read until it is used, and nothing is ever copied
+    # into private memory just to load the matrix
+    arrays = {}
+    for name in ARRAYS:
+        arrays[name] = np.load(os.path.join(path, name+".npy"), mmap_mode=mmap_mode)
+    
+    with open(os.path.join(path, "metadata.json"), "r", encoding='utf-8') as fp:
+        metadata = json.load(fp)
+    metadata["idf"] = arrays["idf"]
+    
+    X = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(metadata["shape"]), copy=False)
+    
+    return X, arrays["y"], metadata
\ No newline at end of file
@@ -1,75 +1,62 @@
 from sklearn.neural_network import MLPClassifier
 from sklearn.svm import LinearSVC
-from sklearn.model_selection import StratifiedKFold, GridSearchCV
+from sklearn.model_selection import StratifiedKFold, ParameterGrid
+from sklearn.base import clone
+from threadpoolctl import threadpool_limits
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 import pandas as pd
 import os
 import pickle
+import json
+import hashlib
+import time
 import numpy as np
-from scipy.stats import t
+from scipy.stats import t, rankdata
+from matrix_store import load_matrix
+from instrumentation import metrics, add_arguments
+from jsonl import read_entries, append_entry
+import argparse
 import traceback
 
+# number of folds in the outer cross-validation and in each grid search
+OUTER_FOLDS = 10
+INNER_FOLDS = 5
+
+# number of processes the fits are spread over
+WORKERS = os.cpu_count()
+
 def main():
     save_path = r'C:\Users\bdardin\Documents\Political Bias Project'
     
-    #unpickle or load the data
-    with open(os.path.join(save_path,"x.txt"), "rb") as fp:
-        X = pickle.load(fp)
-        
-    with open(os.path.join(save_path,"y.txt"), "rb") as fp:
-        Y = pickle.load(fp)
+    #load the data
+    #X is a scipy.sparse CSR matrix, both LinearSVC and MLPClassifier train on it directly
+    #its arrays are memory mapped so the worker processes share the same pages
+    matrix_path = os.path.join(save_path,"matrix")
+    with metrics.stage("load"):
+        X, Y, metadata = load_matrix(matrix_path, mmap_mode='r')
     
     seed = 12345
+    num_trials = 10
+    model_dict = make_model_dict(seed, num_trials)
     
-    # create a dictionary to store the models and the parameters to test    
-    model_dict = {"MLP": {"model":MLPClassifier(solver='adam', activation='relu', random_state=seed),
-                          "params": {"hidden_layer_sizes": [(65,), (500,), (1000,), (1500,), (2000,)]},
-                          "scores": []
-                          },
-                  "SVM": {"model": LinearSVC(random_state=seed),
-                          "params": {'C': [2**-5, 2**-3, 1, 2**3, 2**5]},
-                          "scores": []
-                          }
-                  }
+    # every grid point's inner cross-validation scores and every outer fold's test score are
+    # cached as soon as they are computed, keyed by trial, fold, model, hyperparameters and a
+    # hash of the data. Rerunning skips everything that already finished, so a crash or a new
+    # value in a parameter grid only costs the fits that are actually new
+    with metrics.stage("load"):
+        cache = ResultCache(os.path.join(save_path,"cv_cache.jsonl"), data_hash(X, Y))
     
-    # create a set of trial arrays for each model for trial-level calculations
-    num_trials = 10
-    for k in model_dict.keys():
-        model_dict[k]["trials"] = [[] for _ in range(num_trials)]
+    # run every fit of every trial and fold on one pool of processes
+    with metrics.stage("cross-validation"):
+        run_cross_validation(cache, model_dict, matrix_path, num_trials, save_path)
     
-    # iterate through the trials
-    for i in range(num_trials):
-        # create the stratified cross-validation split for this trial
-        skf = StratifiedKFold(n_splits=10, random_state=i, shuffle=True)
-        
-        # iterate over all the folds of the cross-validation
-        for j, data in enumerate(skf.split(X,Y)):
-            current = "Trial "+str(i)+" Fold "+str(j)
-            print(current)
-            
-            train_index = data[0]
-            test_index = data[1]
-            
-            # create another stratified cross-validation split for the grid search
-            skf_grid = StratifiedKFold(n_splits=5, random_state=10+i*10+j, shuffle=True)
-            
-            for k in model_dict.keys():
-                filename = os.path.join(save_path,k,current)
-                
-                # conduct the grid search using only the training split of the fold
-                clf = GridSearchCV(estimator=model_dict[k]["model"], param_grid=model_dict[k]["params"], cv=skf_grid, verbose=20, n_jobs=-1)
-                clf.fit(X[train_index], Y[train_index])
-                
-                # save the results of the grid search and the winning model
-                pd.DataFrame.from_dict(data=clf.cv_results_, orient='columns').to_csv(filename+'.csv', header=True)
-                pickle.dump(clf, open(filename+".sav", 'wb'))
-                
-                # use the winning model to produce predictions on the test set of the fold
-                score = clf.score(X[test_index], Y[test_index])
-                model_dict[k]["scores"].append(score)
-                model_dict[k]["trials"][i].append(score)
-                
-                with open(os.path.join(save_path,k,"results.txt"), "a",encoding='utf-8',errors='ignore') as text_file:
-                    text_file.write(current+': '+str(score)+'\n\n')
+    # write out every fold's score, all of which are in the cache by now
+    for k in model_dict.keys():
+        with open(os.path.join(save_path,k,"results.txt"), "w",encoding='utf-8',errors='ignore') as text_file:
+            for i, trial in enumerate(model_dict[k]["trials"]):
+                for j, score in enumerate(trial):
+                    text_file.write("Trial "+str(i)+" Fold "+str(j)+': '+str(score)+'\n\n')
     
     # calculate the mean and standard deviation of each trial            
     for k in model_dict.keys():
@@ -104,10 +91,237 @@ def main():
     
     print("mean:",diff_mean,"variance:",variance,"t-stat:",t_stat,"p-value:",pval)
                     
+def make_model_dict(seed, num_trials, grids=None):
+    # create a dictionary to store the models and the parameters to test
+    # grids can replace the parameters to test, keyed by model name
+    model_dict = {"MLP": {"model":MLPClassifier(solver='adam', activation='relu', random_state=seed),
+                          "params": {"hidden_layer_sizes": [(65,), (500,), (1000,), (1500,), (2000,)]},
+                          "scores": []
+                          },
+                  "SVM": {"model": LinearSVC(random_state=seed),
+                          "params": {'C': [2**-5, 2**-3, 1, 2**3, 2**5]},
+                          "scores": []
+                          }
+                  }
+    
+    # create a set of trial arrays for each model for trial-level calculations
+    for k in model_dict.keys():
+        if grids is not None:
+            model_dict[k]["params"] = grids[k]
+        model_dict[k]["trials"] = [[] for _ in range(num_trials)]
+    
+    return model_dict
+
+class ResultCache:
+    # results are appended to a JSON lines file the moment they are computed, so a crash only
+    # loses the fits that were still running (and at most the line being written when it
+    # happened). Entries computed on different data are ignored
+    def __init__(self, path, data_hash):
+        self.path = path
+        self.data_hash = data_hash
+        self.results = {}
+        
+        for entry in read_entries(path):
+            self.results[entry["key"]] = entry["value"]
+    
+    def key(self, *parts):
+        # the parts (trial, fold, model, hyperparameters...) are hashed along with the data hash
+        parts = json.dumps([self.data_hash, parts], sort_keys=True, default=str)
+        return hashlib.sha1(parts.encode('utf-8')).hexdigest()
+    
+    def get(self, *parts):
+        return self.results.get(self.key(*parts))
+    
+    def put(self, value, *parts):
+        key = self.key(*parts)
+        self.results[key] = value
+        append_entry(self.path, {"key": key, "value": value})
+
+def data_hash(X, Y):
+    # a fingerprint of the term-document matrix and the labels
+    h = hashlib.sha1()
+    h.update(str(X.shape).encode('utf-8'))
+    for a in [X.data, X.indices, X.indptr, Y]:
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+def run_cross_validation(cache, model_dict, matrix_path, num_trials, save_path, workers=WORKERS):
+    # instead of only parallelizing inside each grid search, every single fit of the nested
+    # cross-validation (trial, outer fold, model, parameters, inner fold) is queued on one
+    # process pool, so the cores stay busy even when a grid has fewer fits than cores
+    # tasks only carry the trial/fold numbers, every worker memory maps X once and recreates
+    # the same seeded StratifiedKFold splits itself
+    keys = [(i, j, k) for i in range(num_trials) for j in range(OUTER_FOLDS) for k in model_dict.keys()]
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(matrix_path,)) as pool:
+        # first the inner cross-validation of every grid point that isn't cached yet
+        futures = {}
+        for key in keys:
+            i, j, k = key
+            for params in ParameterGrid(model_dict[k]["params"]):
+                estimator = clone(model_dict[k]["model"]).set_params(**params)
+                if cache.get(*key, "grid", estimator.get_params()) is None:
+                    for split in range(INNER_FOLDS):
+                        future = pool.submit(fit_inner_fold, i, j, split, estimator)
+                        futures[future] = (key, split, estimator)
+        
+        print("Queued",len(futures),"grid search fits")
+        with metrics.stage("grid search"):
+            collect_inner_folds(cache, futures)
+        
+        # then refit the winner of every grid search on its whole training split
+        futures = {}
+        for key in keys:
+            i, j, k = key
+            filename = os.path.join(save_path,k,"Trial "+str(i)+" Fold "+str(j))
+            
+            # save the results of the grid search
+            cv_results, best_params = grid_results(cache, key, model_dict[k]["model"], model_dict[k]["params"])
+            pd.DataFrame.from_dict(data=cv_results, orient='columns').to_csv(filename+'.csv', header=True)
+            
+            estimator = clone(model_dict[k]["model"]).set_params(**best_params)
+            if cache.get(*key, "test", estimator.get_params()) is None:
+                future = pool.submit(fit_best, i, j, estimator, filename)
+                futures[future] = (key, estimator)
+        
+        print("Queued",len(futures),"test fits")
+        with metrics.stage("test fits"):
+            for n, future in enumerate(as_completed(futures)):
+                key, estimator = futures[future]
+                score, fit_time = future.result()
+                cache.put({"score": score, "fit_time": fit_time}, *key, "test", estimator.get_params())
+                metrics.add("fits")
+                metrics.add_time("fit", fit_time)
+                print("Trial",key[0],"Fold",key[1],key[2],"test fit",n+1,"of",len(futures),"done")
+    
+    # use the winning models' predictions on the test set of each fold
+    for key in keys:
+        i, j, k = key
+        _, best_params = grid_results(cache, key, model_dict[k]["model"], model_dict[k]["params"])
+        estimator = clone(model_dict[k]["model"]).set_params(**best_params)
+        score = cache.get(*key, "test", estimator.get_params())["score"]
+        model_dict[k]["scores"].append(score)
+        model_dict[k]["trials"][i].append(score)
+
+def collect_inner_folds(cache, futures):
+    # a grid point is cached once all of its inner folds have finished
+    pending = {}
+    for n, future in enumerate(as_completed(futures)):
+        key, split, estimator = futures[future]
+        result = future.result()
+        
+        # the fits run in the worker processes, so their time is added up from the results
+        metrics.add("fits")
+        metrics.add_time("fit", result["fit_time"])
+        metrics.add_time("score", result["score_time"])
+        
+        params = estimator.get_params()
+        folds = pending.setdefault(cache.key(*key, "grid", params), {})
+        folds[split] = result
+        
+        if len(folds) == INNER_FOLDS:
+            result = {name: [folds[s][name] for s in range(INNER_FOLDS)] for name in ["fit_time", "score_time", "test_score"]}
+            cache.put(result, *key, "grid", params)
+        
+        if (n+1) % 100 == 0 or n+1 == len(futures):
+            print(n+1,"of",len(futures),"grid search fits done")
+
+def grid_results(cache, key, model, param_grid):
+    # put the cached results of every grid point back together
+    candidates = list(ParameterGrid(param_grid))
+    results = [cache.get(*key, "grid", clone(model).set_params(**params).get_params()) for params in candidates]
+    return build_cv_results(candidates, results)
+
+def build_cv_results(candidates, results):
+    # lay the results out the same way as GridSearchCV's cv_results_
+    # and pick the best parameters the same way it does (the first of the highest mean scores)
+    cv_results = {}
+    for name in ["fit_time", "score_time"]:
+        times = np.array([r[name] for r in results])
+        cv_results["mean_"+name] = times.mean(axis=1)
+        cv_results["std_"+name] = times.std(axis=1)
+    
+    for name in candidates[0].keys():
+        cv_results["param_"+name] = [c[name] for c in candidates]
+    cv_results["params"] = candidates
+    
+    scores = np.array([r["test_score"] for r in results])
+    for split in range(scores.shape[1]):
+        cv_results["split"+str(split)+"_test_score"] = scores[:,split]
+    cv_results["mean_test_score"] = scores.mean(axis=1)
+    cv_results["std_test_score"] = scores.std(axis=1)
+    cv_results["rank_test_score"] = rankdata(-cv_results["mean_test_score"], method='min').astype(np.int32)
+    
+    best_params = candidates[int(np.argmin(cv_results["rank_test_score"]))]
+    
+    return cv_results, best_params
+
+# the worker processes' copy of the data and of the splits they've recreated
+worker_data = {}
+
+def init_worker(matrix_path):
+    # memory map the matrix so every worker shares the same pages
+    # each worker runs one fit at a time, so BLAS is kept to a single thread
+    threadpool_limits(1)
+    X, Y, _ = load_matrix(matrix_path, mmap_mode='r')
+    worker_data["X"] = X
+    worker_data["Y"] = np.asarray(Y)
+
+@lru_cache(maxsize=4)
+def outer_splits(i):
+    # the same stratified cross-validation split for trial i as StratifiedKFold.split(X,Y)
+    Y = worker_data["Y"]
+    skf = StratifiedKFold(n_splits=OUTER_FOLDS, random_state=i, shuffle=True)
+    return list(skf.split(np.zeros(len(Y)), Y))
+
+@lru_cache(maxsize=16)
+def inner_splits(i, j):
+    # the grid search split of the training part of fold j, mapped back to rows of X
+    train_index = outer_splits(i)[j][0]
+    skf_grid = StratifiedKFold(n_splits=INNER_FOLDS, random_state=10+i*10+j, shuffle=True)
+    return [(train_index[tr], train_index[va]) for tr, va in skf_grid.split(np.zeros(len(train_index)), worker_data["Y"][train_index])]
+
+def fit_inner_fold(i, j, split, estimator):
+    # one fit of the grid search, scored on its validation fold
+    X, Y = worker_data["X"], worker_data["Y"]
+    train_index, val_index = inner_splits(i, j)[split]
+    
+    start = time.time()
+    estimator.fit(X[train_index], Y[train_index])
+    fit_time = time.time() - start
+    
+    start = time.time()
+    score = estimator.score(X[val_index], Y[val_index])
+    score_time = time.time() - start
+    
+    return {"fit_time": fit_time, "score_time": score_time, "test_score": score}
+
+def fit_best(i, j, estimator, filename):
+    # refit the winning parameters on the whole training split and score the test split
+    # the refit model is saved alongside the grid search results
+    X, Y = worker_data["X"], worker_data["Y"]
+    train_index, test_index = outer_splits(i)[j]
+    
+    start = time.time()
+    estimator.fit(X[train_index], Y[train_index])
+    fit_time = time.time() - start
+    with open(filename+".sav", 'wb') as fp:
+        pickle.dump(estimator, fp)
+    
+    return estimator.score(X[test_index], Y[test_index]), fit_time
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the nested cross-validation and compare the models")
+    add_arguments(parser)
+    args = parser.parse_args()
+    
     # wrap the program in a try/except block in case there are errors
+    # the metrics and profile are written even if the run fails part way through
+    metrics.start(profile=args.profile is not None, trace_memory=args.trace_memory)
     try:
         main()
     except Exception as e:
         print(e)
-        print(traceback.format_exc())
\ No newline at end of file
+        print(traceback.format_exc())
+    finally:
+        metrics.finish(args.metrics, args.profile)
\ No newline at end of file
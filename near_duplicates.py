@@ -0,0 +1,174 @@
+from jsonl import read_entries, append_entry
+import numpy as np
+import zlib
+import json
+import os
+
+# Finds articles that are near-duplicates of ones already saved, like wire copy published
+# by both sites or a lightly edited repost under a new URL. Every article is cut into
+# overlapping runs of words (shingles) and summarized by a MinHash signature, whose
+# positions match between two articles with a probability equal to the share of shingles
+# they have in common. The signature is split into bands, and two articles only get compared
+# if they are identical on at least one whole band, so finding the matches of an article
+# looks up one bucket per band instead of comparing it with every other article.
+#
+# The index is a folder holding its settings (params.json), the signatures one after the
+# other as 32 bit integers (signatures.bin), the key of each one (keys.jsonl), the keys of
+# the articles that were skipped as near-duplicates (skipped.jsonl) and the keys of the ones
+# that were saved anyway along with what they duplicate (saved_duplicates.jsonl), so they
+# can be left out later on. The files are only ever appended to, so adding an article never
+# rewrites the index. Adding a key that is already indexed replaces its signature, and when
+# the index is loaded later lines win
+
+# hashes are taken modulo this prime, and are below 2^31 so products fit in 64 bits
+PRIME = (1 << 31) - 1
+
+class NearDuplicateIndex:
+    # num_perm is the length of the signatures and bands the number of pieces they're cut into
+    # articles are near-duplicates if about threshold of their shingles are the same
+    # with 16 bands of 8 values, articles sharing 70% of their shingles have even odds of
+    # being compared, and the chance quickly approaches 1 above that
+    def __init__(self, path, num_perm=128, bands=16, shingle_size=5, threshold=0.8, seed=1):
+        self.path = path
+        self.params_path = os.path.join(path, "params.json")
+        self.signatures_path = os.path.join(path, "signatures.bin")
+        self.keys_path = os.path.join(path, "keys.jsonl")
+        self.skipped_path = os.path.join(path, "skipped.jsonl")
+        self.saved_duplicates_path = os.path.join(path, "saved_duplicates.jsonl")
+        os.makedirs(path, exist_ok=True)
+        
+        # the settings of an existing index win, since its signatures depend on them
+        params = {"num_perm": num_perm, "bands": bands, "shingle_size": shingle_size, "seed": seed}
+        if os.path.exists(self.params_path):
+            with open(self.params_path, "r", encoding='utf-8') as fp:
+                params = json.load(fp)
+        else:
+            with open(self.params_path, "w", encoding='utf-8') as fp:
+                json.dump(params, fp)
+        
+        self.num_perm = params["num_perm"]
+        self.bands = params["bands"]
+        self.rows = self.num_perm // self.bands
+        self.shingle_size = params["shingle_size"]
+        self.threshold = threshold
+        
+        # one random hash function (a*x + b) mod PRIME per signature position
+        rng = np.random.default_rng(params["seed"])
+        self.a = rng.integers(1, PRIME, self.num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, self.num_perm, dtype=np.uint64)
+        
+        # a key is only written after its signature, so if a crash cut the last write short
+        # the extra signature (and a key line that was cut short) is dropped
+        keys = [entry["key"] for entry in read_entries(self.keys_path)]
+        
+        signatures = np.zeros((0, self.num_perm), dtype=np.uint32)
+        if os.path.exists(self.signatures_path):
+            signatures = np.fromfile(self.signatures_path, dtype=np.uint32)
+            signatures = signatures[:len(signatures)//self.num_perm*self.num_perm].reshape(-1, self.num_perm)
+        
+        n = min(len(keys), len(signatures))
+        if n < len(signatures):
+            with open(self.signatures_path, "r+b") as fp:
+                fp.truncate(n*self.num_perm*4)
+        
+        self.keys = []
+        self.key_rows = {}
+        self.signatures = []
+        self.buckets = [{} for _ in range(self.bands)]
+        for key, signature in zip(keys[:n], signatures[:n]):
+            self.insert(key, signature)
+        
+        # map every skipped or saved near-duplicate to the key of the article it duplicates
+        self.skipped = {entry["key"]: entry["duplicate_of"] for entry in read_entries(self.skipped_path)}
+        self.saved_duplicates = {entry["key"]: entry["duplicate_of"] for entry in read_entries(self.saved_duplicates_path)}
+    
+    def __len__(self):
+        return len(self.key_rows)
+    
+    def __contains__(self, key):
+        return key in self.key_rows
+    
+    def signature(self, text):
+        # the MinHash signature of an article's processed text, or None if it has no words
+        words = text.split() if text is not None else []
+        if len(words) == 0:
+            return None
+        
+        # articles shorter than a shingle are a single shingle
+        n = min(self.shingle_size, len(words))
+        shingles = set(" ".join(words[i:i+n]) for i in range(len(words)-n+1))
+        
+        # every shingle gets a stable 32 bit hash (Python's own hash changes between runs)
+        # then every hash function is applied to all of them at once and the minimum is kept
+        x = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles)) % PRIME
+        return ((np.outer(x, self.a) + self.b) % PRIME).min(axis=0).astype(np.uint32)
+    
+    def band_keys(self, signature):
+        return [signature[i*self.rows:(i+1)*self.rows].tobytes() for i in range(self.bands)]
+    
+    def query(self, signature, exclude=None):
+        # the keys of the indexed articles that are near-duplicates of the signature, with
+        # their estimated similarity, most similar first. exclude is a key to leave out,
+        # for when an article is already in the index under its own key
+        if signature is None:
+            return []
+        
+        candidates = set()
+        for band, band_key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(band.get(band_key, ()))
+        
+        matches = []
+        for row in candidates:
+            if self.keys[row] == exclude:
+                continue
+            similarity = float(np.mean(self.signatures[row] == signature))
+            if similarity >= self.threshold:
+                matches.append((self.keys[row], similarity))
+        
+        return sorted(matches, key=lambda m: -m[1])
+    
+    def add(self, key, signature):
+        # add an article to the index and append it to the files
+        # articles without any words are stored with a signature no real article can have
+        # (every MinHash value is below PRIME), so they are known to be indexed but never match
+        if signature is None:
+            signature = np.full(self.num_perm, PRIME, dtype=np.uint32)
+        
+        with open(self.signatures_path, "ab") as fp:
+            fp.write(np.asarray(signature, dtype=np.uint32).tobytes())
+        append_entry(self.keys_path, {"key": key})
+        
+        self.insert(key, signature)
+    
+    def skip(self, key, duplicate_of):
+        # remember that an article was left out as a near-duplicate, without indexing it
+        if key in self.skipped:
+            return
+        
+        self.skipped[key] = duplicate_of
+        append_entry(self.skipped_path, {"key": key, "duplicate_of": duplicate_of})
+    
+    def flag(self, key, duplicate_of):
+        # remember that an article was saved even though it's a near-duplicate
+        if self.saved_duplicates.get(key) == duplicate_of:
+            return
+        
+        self.saved_duplicates[key] = duplicate_of
+        append_entry(self.saved_duplicates_path, {"key": key, "duplicate_of": duplicate_of})
+    
+    def insert(self, key, signature):
+        # an older signature of the same key is taken out of its buckets
+        if key in self.key_rows:
+            old = self.key_rows[key]
+            if self.signatures[old][0] != PRIME:
+                for band, band_key in zip(self.buckets, self.band_keys(self.signatures[old])):
+                    band[band_key].remove(old)
+        
+        row = len(self.keys)
+        self.keys.append(key)
+        self.key_rows[key] = row
+        self.signatures.append(signature)
+        if signature[0] == PRIME:
+            return
+        for band, band_key in zip(self.buckets, self.band_keys(signature)):
+            band.setdefault(band_key, []).append(row)
\ No newline at end of file
@@ -0,0 +1,61 @@
+from jsonl import read_entries, append_entry
+import hashlib
+import gzip
+import os
+
+# Every fetched page is kept in a local archive so the text can be re-extracted later
+# without downloading it again. Pages are gzip compressed and stored under the SHA-256
+# of their HTML, so identical pages are only stored once, and index.jsonl maps every URL
+# (along with its site) to the hash of the last copy fetched
+
+class PageArchive:
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, "index.jsonl")
+        os.makedirs(os.path.join(path, "pages"), exist_ok=True)
+        
+        # later lines win, so re-fetching a URL points it at the new copy
+        # a line cut short by a crash is dropped, its page is simply fetched again
+        self.index = {}
+        for entry in read_entries(self.index_path):
+            self.index[entry["url"]] = (entry["site"], entry["sha256"])
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def __contains__(self, url):
+        return url in self.index
+    
+    def __iter__(self):
+        # yields (site, url, sha256) for every archived URL
+        for url, (site, digest) in self.index.items():
+            yield site, url, digest
+    
+    def put(self, site, url, html):
+        digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+        blob = page_path(self.path, digest)
+        
+        # write to a temporary file first so a crash never leaves a truncated page behind
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            with gzip.open(blob+".tmp", "wt", encoding='utf-8') as fp:
+                fp.write(html)
+            os.replace(blob+".tmp", blob)
+        
+        if self.index.get(url) != (site, digest):
+            self.index[url] = (site, digest)
+            append_entry(self.index_path, {"url": url, "site": site, "sha256": digest})
+        
+        return digest
+    
+    def get(self, url):
+        return load_page(self.path, self.index[url][1])
+
+def page_path(path, digest):
+    # pages are spread over subdirectories by the first two characters of their hash
+    return os.path.join(path, "pages", digest[:2], digest+".html.gz")
+
+def load_page(path, digest):
+    # a plain function so worker processes can read pages without loading the index
+    with gzip.open(page_path(path, digest), "rt", encoding='utf-8') as fp:
+        return fp.read()
\ No newline at end of file
@@ -0,0 +1,97 @@
+import numpy as np
+
+# Generates fake news articles for benchmarking. Word frequencies follow a Zipf
+# distribution like real text, and the articles are sprinkled with the things
+# process_text has to deal with: abbreviations (U.S., a.m.), acronyms (FBI, N.A.T.O.),
+# initials, numbers, punctuation and non-breaking spaces
+
+ABBREVIATIONS = ["U.S.", "a.m.", "p.m.", "D.C.", "U.N.", "U.K."]
+ACRONYMS = ["FBI", "GOP", "NATO", "EPA", "N.A.T.O.", "ICE", "DOJ", "CNN"]
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+SOURCES = ["fox", "huffpo"]
+
+def make_vocabulary(size, rng):
+    # random pronounceable-ish words, with lengths roughly like English words
+    lengths = np.clip(rng.poisson(6, size), 1, 20)
+    return ["".join(rng.choice(list(LETTERS), n)) for n in lengths]
+
+def zipf_weights(size):
+    weights = 1.0 / np.arange(1, size+1)
+    return weights / weights.sum()
+
+def generate_text(rng, vocabulary, weights, words_per_article):
+    length = max(20, int(rng.normal(words_per_article, words_per_article/4)))
+    words = [vocabulary[i] for i in rng.choice(len(vocabulary), length, p=weights)]
+    
+    text = []
+    start = True
+    for w in words:
+        r = rng.random()
+        if r < 0.01:
+            w = ABBREVIATIONS[rng.integers(len(ABBREVIATIONS))]
+        elif r < 0.02:
+            w = ACRONYMS[rng.integers(len(ACRONYMS))]
+        elif r < 0.025:
+            w = str(rng.integers(1, 3000))
+        elif r < 0.03:
+            w = LETTERS[rng.integers(26)].upper() + ". " + w.capitalize()
+        
+        if start:
+            w = w[0].upper() + w[1:]
+            start = False
+        
+        r = rng.random()
+        if r < 0.06:
+            w += "."
+            start = True
+        elif r < 0.1:
+            w += ","
+        elif r < 0.105:
+            w += "?"
+            start = True
+        elif r < 0.11:
+            w += ":"
+        text.append(w)
+        text.append("\xa0" if rng.random() < 0.002 else " ")
+    
+    return "".join(text)
+
+def generate_articles(n_articles, vocabulary_size=50000, words_per_article=600, seed=0):
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    weights = zipf_weights(vocabulary_size)
+    
+    return [generate_text(rng, vocabulary, weights, words_per_article) for _ in range(n_articles)]
+
+def generate_corpus(n_articles, vocabulary_size=50000, words_per_article=600, seed=0, bias=3.0):
+    # a labelled corpus alternating between the sources. Each source favours its own random
+    # 2% of the vocabulary (bias times as likely), so there is something for the models to learn
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    
+    source_weights = {}
+    for source in SOURCES:
+        weights = zipf_weights(vocabulary_size)
+        favoured = rng.choice(vocabulary_size, max(1, vocabulary_size//50), replace=False)
+        weights[favoured] *= bias
+        source_weights[source] = weights / weights.sum()
+    
+    corpus = []
+    for i in range(n_articles):
+        source = SOURCES[i % len(SOURCES)]
+        corpus.append((source, generate_text(rng, vocabulary, source_weights[source], words_per_article)))
+    
+    return corpus
+
+def article_html(site, text):
+    # an article page laid out the way extract_text expects for each site,
+    # with the text split into paragraphs of about 60 words
+    words = text.split(" ")
+    paragraphs = [" ".join(words[i:i+60]) for i in range(0, len(words), 60)]
+    
+    if "fox" in site:
+        body = '<div class="article-body">' + "".join("<p>"+p+"</p>" for p in paragraphs) + '</div>'
+    else:
+        body = '<div class="entry__text">' + "".join('<div class="text">'+p+'</div>' for p in paragraphs) + '</div>'
+    
+    return '<html><head><title>Article</title></head><body><header>Politics</header>' + body + '</body></html>'
\ No newline at end of file
@@ -0,0 +1,102 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+import re
+
+# The patterns are compiled once when the module is imported instead of every time an
+# article is processed
+
+#2 letter abbreviations separated with periods (a.m., U.S.)
+ABBREVIATION = re.compile(r'[A-Za-z]\.[A-Za-z]\.')
+
+#periods of acronyms longer than 2 characters, the letter before the period is removed too
+#(a capital letter with no word character before it is the same as \b followed by a capital)
+ACRONYM_PERIOD = re.compile(r'\b[A-Z]\.')
+
+#numbers and special characters except periods, colons, question marks and spaces
+SPECIAL_CHARACTERS = re.compile('[^A-Za-z.?: ]+')
+
+def process_text(proc):
+    #in case the text has this character, make sure it's replaced with a space 
+    #so word boundaries are respected
+    proc = proc.replace("\xa0"," ")
+    
+    #this finds 2 letter abbreviations and removes the periods so they can be considered as n-grams
+    for m in ABBREVIATION.findall(proc):
+        proc = proc.replace(m, m.replace('.',''))
+    
+    proc = ACRONYM_PERIOD.sub('', proc)
+    proc = SPECIAL_CHARACTERS.sub('', proc)
+    
+    #once the special characters are gone, the sentence boundaries are the only characters
+    #left besides letters and spaces. Turning them into spaces respects the boundaries
+    #(otherwise the words combine) and split() drops any extra whitespace that introduces
+    words = proc.replace('.',' ').replace('?',' ').replace(':',' ').split()
+    
+    #now we convert all the words or ngrams to lower case, unless the ngram is an acronym
+    #then we know it is a different ngram and should be stored in upper case
+    #only letters are left, so s.isupper() is the same check as s == s.upper()
+    return " ".join([s if s.isupper() and 1 < len(s) < 6 else s.lower() for s in words])
+
+def process_texts(texts, workers=None, chunksize=64):
+    # process a batch of documents across a pool of processes, the results are in the same
+    # order as the texts. workers=1 processes them in this process instead
+    if workers == 1:
+        return [process_text(t) for t in texts]
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(process_text, texts, chunksize=chunksize))
+
+def count_ngrams(text, ngram_range=(1,1)):
+    # count every ngram of the processed text with between ngram_range[0] and ngram_range[1]
+    # words, multi-word ngrams are the words joined by single spaces
+    tokens = text.split(" ")
+    if ngram_range == (1,1):
+        return Counter(tokens)
+    
+    counts = Counter()
+    for n in range(ngram_range[0], ngram_range[1]+1):
+        counts.update(map(" ".join, zip(*[tokens[i:] for i in range(n)])))
+    return counts
+
+def augmented_tf(ngrams, a=0.5):
+    # calculate the augmented term frequency of each ngram in an article
+    # using the frequency of the article's most common ngram
+    if len(ngrams) == 0:
+        return {}
+    mostCommon = max(ngrams.values())
+    return {n: a + a*f/mostCommon for n, f in ngrams.items()}
+
+class NgramEncoder:
+    # gives every token an integer ID (starting at 1) and packs a sequence of IDs into a single
+    # integer, so ngrams can be counted without building a string for each one
+    # every ID takes up BITS bits of the packed key, so keys of different lengths never collide
+    BITS = 32
+    
+    def __init__(self):
+        self.ids = {}
+        self.tokens = [None]
+    
+    def encode(self, tokens):
+        ids = []
+        for token in tokens:
+            i = self.ids.get(token)
+            if i is None:
+                i = len(self.tokens)
+                self.ids[token] = i
+                self.tokens.append(token)
+            ids.append(i)
+        return ids
+    
+    def pack(self, ids):
+        key = 0
+        for i in ids:
+            key = (key << self.BITS) | i
+        return key
+    
+    def decode(self, key):
+        mask = (1 << self.BITS) - 1
+        tokens = []
+        while key:
+            tokens.append(self.tokens[key & mask])
+            key >>= self.BITS
+        return " ".join(reversed(tokens))
\ No newline at end of file
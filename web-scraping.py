@@ -3,14 +3,81 @@ from bs4 import BeautifulSoup
 from sqlalchemy import create_engine
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice, zip_longest
+from urllib.parse import urlparse
+from page_archive import PageArchive, load_page
+from near_duplicates import NearDuplicateIndex
+from text_processing import process_text
+from instrumentation import metrics, add_arguments
+import urllib.request
+import argparse
+import hashlib
+import os
+import threading
+import time
 import random
 import numpy as np
-import re
 import traceback
 
-def main():
+# number of article pages fetched at the same time
+FETCH_WORKERS = 8
+
+# article pages don't need the "load more" clicking and their text is in the HTML the server
+# sends, so by default they are fetched with plain HTTP requests. Set this to True to fetch
+# them with a pool of headless browsers instead
+FETCH_WITH_BROWSER = False
+
+# minimum number of seconds between two requests to the same host
+HOST_DELAY = 0.5
+
+# number of times a failed request is retried before the article is skipped
+FETCH_RETRIES = 3
+
+# where the HTML of every fetched page is archived
+ARCHIVE_PATH = r'C:\Users\bdardin\Documents\Political Bias Project\pages'
+
+# where the near-duplicate index of the saved articles is kept
+DUPLICATES_PATH = r'C:\Users\bdardin\Documents\Political Bias Project\near_duplicates'
+
+# share of shingles two articles need in common to be considered near-duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+# skip near-duplicates of articles that are already saved, otherwise they are saved anyway
+# and recorded in the index's saved_duplicates.jsonl
+SKIP_NEAR_DUPLICATES = True
+
+# number of processes used to re-extract the text of archived pages
+REPLAY_WORKERS = os.cpu_count()
+
+# number of processed articles added to the session before they are committed
+COMMIT_EVERY = 50
+
+# seconds to wait for more articles to show up after clicking "load more"
+LOAD_MORE_TIMEOUT = 10
+
+# scripts run in the browser to read fox's list of articles without serializing the page
+FOX_ARTICLE_COUNT_SCRIPT = """
+return document.querySelectorAll('section.has-load-more article').length;
+"""
+NEW_FOX_LINKS_SCRIPT = """
+var articles = document.querySelectorAll('section.has-load-more article');
+var hrefs = [];
+for (var i = arguments[0]; i < articles.length; i++) {
+    var links = articles[i].querySelectorAll('a');
+    for (var j = 0; j < links.length; j++) {
+        hrefs.push(links[j].getAttribute('href'));
+    }
+}
+return [articles.length, hrefs];
+"""
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/76.0.3809.100 Safari/537.36'
+
+def main(replay=False):
     #create database connection
     engine = create_engine('mssql://BRIANNA\\SQLEXPRESS/article_bias?trusted_connection=yes&driver=SQL+Server')
+    metrics.watch_engine(engine)
     
     #map the database structure onto an object oriented model for simpler processing
     Base = automap_base()
@@ -23,26 +90,40 @@ def main():
     #using this object relational model, create a session with the database
     session = Session(engine)
     
-    #query for existing articles in the database and save their URLs in a list
+    #every page fetched is saved to the archive
+    archive = PageArchive(ARCHIVE_PATH)
+    
+    #in replay mode nothing is fetched, the text of every article is re-derived from the
+    #archived pages instead
+    if replay:
+        duplicates = NearDuplicateIndex(DUPLICATES_PATH, threshold=NEAR_DUPLICATE_THRESHOLD)
+        replay_archive(session, Article, archive, duplicates)
+        return
+    
+    #query for the URLs of existing articles in the database and save them in a set
     #this ensures that duplicate articles aren't added to the corpus
-    allArticles = session.query(Article).all()
-    old_urls = []
+    #only the URL column is loaded, not the article text
+    #newly found URLs are added to a copy of the set so each one is only saved once
+    old_urls = set(url for (url,) in session.query(Article.article_url))
+    seen_urls = set(old_urls)
+    
+    #the same story often shows up under different URLs (wire copy, reposts), so the text of
+    #every new article is also checked against an index of the saved articles' text
+    duplicates = NearDuplicateIndex(DUPLICATES_PATH, threshold=NEAR_DUPLICATE_THRESHOLD)
+    with metrics.stage("index articles"):
+        index_articles(session, Article, duplicates, old_urls)
     
-    if len(allArticles) > 0:
-        for art in allArticles:
-            old_urls.append(art.article_url)
+    #URLs skipped as near-duplicates by earlier runs are treated like saved ones, so they
+    #aren't fetched again and don't keep the fox crawl going
+    old_urls.update(duplicates.skipped)
+    seen_urls.update(duplicates.skipped)
     
     # create the window-less Chrome browser so we can click "load more" buttons
-    options = webdriver.ChromeOptions()
-    options.add_argument('--headless')
-    options.add_argument('--window-size=1920,1080')
-    driver = webdriver.Chrome(options=options)
+    driver = create_driver()
     
-    # create a dictionary to store the URLs and later the article objects for each site
-    site_dict = {"fox": {"urls": [],
-                        "articles": [] },
-                 "huffpo": {"urls": [],
-                            "articles": [] }
+    # create a dictionary to store the URLs for each site
+    site_dict = {"fox": {"urls": [] },
+                 "huffpo": {"urls": [] }
                 }
     
     # since HuffPo's politics section is paginated, do a while loop and
@@ -54,9 +135,11 @@ def main():
     while huffpo_page < 24:
         # request the URL and retrieve the HTML
         huffpo_url = huffpo_base + '/section/politics?page=' + str(huffpo_page)
-        driver.get(huffpo_url)
-        html = driver.page_source
-        soup = BeautifulSoup(html, "lxml")
+        with metrics.stage("listing"):
+            driver.get(huffpo_url)
+            html = driver.page_source
+            soup = BeautifulSoup(html, "lxml")
+            metrics.add("listing_pages")
         
         # each article on the page is displayed in its own "card"
         page_articles = soup.find_all("div", {"class": "card__details"})
@@ -71,7 +154,8 @@ def main():
                 else:
                     # save the article URL to the list if it wasn't already added
                     url = huffpo_base + p.find("a").get("href")
-                    if url not in old_urls and url not in site_dict["huffpo"]["urls"]:
+                    if url not in seen_urls:
+                        seen_urls.add(url)
                         site_dict["huffpo"]["urls"].append(url)
                     else:
                         continue
@@ -90,85 +174,374 @@ def main():
 
     for c in fox_categories:
         print(c)
-        driver.get(fox_base+c)
-        
-        # keep track of how many articles are being displayed on the page
-        previous_length = 0
-        while True:
-            # get the HTML
-            html = driver.page_source
-            soup = BeautifulSoup(html, "lxml")
-            
-            # find the list of articles
-            main_list = soup.find("section", {"class": "has-load-more"})
-            main_articles = main_list.find_all("article")
-            
-            # iterate only through the articles that were newly added
-            # instead of processing previously seen articles
-            for m in main_articles[previous_length:]:
-                links = m.find_all("a")
-                for l in links:
-                    # save the article URL to the list if it wasn't already added
-                    url = fox_base + l.get("href")
-                    if url != None and url not in old_urls and url not in site_dict["fox"]["urls"]:
-                        site_dict["fox"]["urls"].append(url)
-            
-            # update the previous length so the next loop knows where to start
-            previous_length = len(main_articles)
-            print("new previous length",previous_length)
-            
-            # find the load more button
-            button = driver.find_element_by_css_selector("div.load-more")
-            
-            # if it is possible to click on the button, keep the loop going
-            # and add as many URLs as possible
-            # if clicking the button fails, break and move to the next section
-            try:
-                button.click()
-                print("click successful")
-            except:
-                print("click failed")
-                break
+        with metrics.stage("listing"):
+            for url in crawl_fox_category(driver, fox_base, c, old_urls):
+                # save the article URL to the list if it wasn't already added
+                if url not in seen_urls:
+                    seen_urls.add(url)
+                    site_dict["fox"]["urls"].append(url)
     
-    # now that we have the article URLs, we can process them and add to the database
+    # the listing pages are done, so the browser used to click through them can be closed
+    driver.quit()
+    
+    # initially the idea was to use a train/test split so each article was randomly assigned 
+    # to be either training or test. ultimately chose to use cross-validation instead but 
+    # this split is still saved in the DB. The split only depends on the number of URLs
+    # for each site, so it is decided up front and articles can be processed in any order
     random.seed(1)
     for site in site_dict.keys():
-        for i, u in enumerate(site_dict[site]["urls"]):
-            # get the HTHML for the article
-            driver.get(u)
-            art_html = driver.page_source
-            soup = BeautifulSoup(art_html, "lxml")
+        site_dict[site]["is_training"] = training_split(len(site_dict[site]["urls"]))
+    
+    # now that we have the article URLs, we can fetch them concurrently and process each one
+    # as soon as it arrives
+    # the sites take turns in the job list, so the fetch window always holds pages from every
+    # host and each host's rate limit is used at the same time instead of one after the other
+    fetcher = PageFetcher(FETCH_WORKERS, FETCH_WITH_BROWSER, HOST_DELAY, FETCH_RETRIES)
+    site_jobs = [[((site, i), u) for i, u in enumerate(site_dict[site]["urls"])] for site in site_dict.keys()]
+    jobs = [job for turn in zip_longest(*site_jobs) for job in turn if job is not None]
+    
+    # articles are committed in batches as they are processed, so memory stays flat and
+    # if the crawl stops, the next run skips every URL that was already saved
+    pending = 0
+    try:
+        for (site, i), art_html in fetcher.fetch(jobs):
+            u = site_dict[site]["urls"][i]
+            if art_html is None:
+                print("Failed to fetch",site,"article #",i+1,u)
+                continue
+            
+            with metrics.stage("archive"):
+                archive.put(site, u, art_html)
             
             # first get the raw text of the article then process the text
             # these were placed in separate functions mainly to improve readability
-            raw_text = extract_text(site, soup)
-            processed = process_text(raw_text)
+            # a page without the expected layout is skipped (it stays in the archive, so
+            # it can be picked up by a replay once extract_text handles it)
+            try:
+                with metrics.stage("parse"):
+                    soup = BeautifulSoup(art_html, "lxml")
+                    raw_text = extract_text(site, soup)
+            except Exception as e:
+                print("Failed to extract",site,"article #",i+1,u,":",e)
+                metrics.add("failed_extractions")
+                continue
+            with metrics.stage("normalize"):
+                processed = process_text(raw_text)
+            
+            # look for saved articles with nearly the same text, the URL itself is excluded
+            # in case it was indexed by a run that stopped before committing it
+            with metrics.stage("deduplicate"):
+                signature = duplicates.signature(processed)
+                matches = duplicates.query(signature, exclude=u)
+            if len(matches) > 0:
+                print(site,"article #",i+1,"is a near-duplicate of",matches[0][0],"(",round(matches[0][1],2),")")
+                metrics.add("near_duplicates")
+                if SKIP_NEAR_DUPLICATES:
+                    duplicates.skip(u, matches[0][0])
+                    continue
+                duplicates.flag(u, matches[0][0])
+            duplicates.add(u, signature)
             
             # create an Article object that will commit the data to the database
-            new_article = Article(source_name=site,article_url=u,raw_text=raw_text,processed_text=processed)
-            site_dict[site]["articles"].append(new_article)
+            new_article = Article(source_name=site,article_url=u,raw_text=raw_text,processed_text=processed,
+                                  is_training=site_dict[site]["is_training"][i])
+            session.add(new_article)
+            metrics.add("articles_added")
             print("Processed",site,"article #",i+1)
+            
+            pending += 1
+            if pending == COMMIT_EVERY:
+                with metrics.stage("commit"):
+                    session.commit()
+                pending = 0
+    finally:
+        fetcher.close()
         
-        # initially the idea was to use a train/test split so each article was randomly assigned 
-        # to be either training or test by creating a list of indices corresponding to the 
-        # number of articles and then randomly shuffling them. 
-        # ultimately chose to use cross-validation instead but this split is still saved in the DB
-        randomList = np.arange(0,len(site_dict[site]["articles"]))
-        random.shuffle(randomList)
+        # commit whatever is left over from the last batch
+        with metrics.stage("commit"):
+            session.commit()
+
+def index_articles(session, Article, duplicates, urls):
+    # add any saved articles the near-duplicate index doesn't know about yet, which is all of
+    # them the first time. Only the URL and processed text are read, a chunk at a time
+    missing = len([u for u in urls if u not in duplicates])
+    if missing == 0:
+        return
+    
+    # near-duplicates that were saved before the index existed are kept, since the later
+    # stages would need to be rerun without them, but each one is recorded in the index
+    # along with the article it duplicates so it can be left out downstream
+    print("Adding",missing,"articles to the near-duplicate index")
+    found = 0
+    query = session.query(Article.article_url, Article.processed_text).order_by(Article.article_id)
+    for url, processed in query.yield_per(COMMIT_EVERY*20):
+        if url not in duplicates:
+            signature = duplicates.signature(processed)
+            matches = duplicates.query(signature)
+            if len(matches) > 0:
+                found += 1
+                duplicates.flag(url, matches[0][0])
+            duplicates.add(url, signature)
+            metrics.add("articles_indexed")
+    
+    if found > 0:
+        print(found,"saved articles are near-duplicates of earlier ones, they are listed in",duplicates.saved_duplicates_path)
+        metrics.add("saved_near_duplicates", found)
+
+def replay_archive(session, Article, archive, duplicates):
+    # re-run extract_text and process_text over every archived page, spread across all the
+    # cores, and update the text of the matching articles in the database
+    # articles whose processed text changed get a new near-duplicate signature, but their
+    # existing TF-IDF vectors are left alone, so data-processing.py has to be run with
+    # --rebuild for the new text to reach the matrix
+    article_ids = {}
+    old_digests = {}
+    for url, article_id, processed in session.query(Article.article_url, Article.article_id, Article.processed_text) \
+                                             .yield_per(COMMIT_EVERY*20):
+        article_ids[url] = article_id
+        old_digests[url] = text_digest(processed)
+    jobs = [(archive.path, site, url, digest) for site, url, digest in archive if url in article_ids]
+    print("Replaying",len(jobs),"of",len(archive),"archived pages")
+    
+    updates = []
+    changed = 0
+    with metrics.stage("replay"), ProcessPoolExecutor(max_workers=REPLAY_WORKERS) as pool:
+        for i, (url, raw_text, processed) in enumerate(pool.map(replay_page, jobs, chunksize=64)):
+            if raw_text is None:
+                print("Failed to extract",url)
+                metrics.add("replay_failures")
+                continue
+            
+            metrics.add("pages_replayed")
+            if text_digest(processed) != old_digests[url]:
+                changed += 1
+                duplicates.add(url, duplicates.signature(processed))
+            updates.append({"article_id": article_ids[url], "raw_text": raw_text, "processed_text": processed})
+            if len(updates) == COMMIT_EVERY*10:
+                with metrics.stage("commit"):
+                    session.bulk_update_mappings(Article, updates)
+                    session.commit()
+                updates = []
+                print("Replayed",i+1,"pages")
+    
+    with metrics.stage("commit"):
+        session.bulk_update_mappings(Article, updates)
+        session.commit()
+    
+    metrics.add("texts_changed", changed)
+    if changed > 0:
+        print("The processed text of",changed,"articles changed, run data-processing.py --rebuild "
+              "to recalculate their TF-IDF scores")
+
+def text_digest(text):
+    # a fingerprint of an article's processed text, so the old text doesn't have to be kept
+    return hashlib.sha1(text.encode('utf-8')).hexdigest() if text is not None else None
+
+def replay_page(job):
+    # runs in a worker process, so it only gets the location of the page and not the page itself
+    path, site, url, digest = job
+    try:
+        soup = BeautifulSoup(load_page(path, digest), "lxml")
+        raw_text = extract_text(site, soup)
+        return url, raw_text, process_text(raw_text)
+    except Exception:
+        return url, None, None
+
+def crawl_fox_category(driver, fox_base, category, old_urls):
+    # fox's sections show more articles every time the "load more" button is clicked
+    # instead of re-parsing the whole page after every click, only the article nodes added
+    # by the click are read from the live page. The URLs are yielded as they are found
+    driver.get(fox_base+category)
+    
+    # keep track of how many articles are being displayed on the page
+    # and which URLs were found in this section
+    previous_length = 0
+    found = set()
+    while True:
+        # read the links of only the articles that were newly added
+        length, hrefs = driver.execute_script(NEW_FOX_LINKS_SCRIPT, previous_length)
+        
+        new_urls = []
+        for href in hrefs:
+            if href is None:
+                continue
+            url = fox_base + href
+            if url not in found:
+                found.add(url)
+                new_urls.append(url)
+        yield from new_urls
+        
+        # update the previous length so the next loop knows where to start
+        previous_length = length
+        metrics.add("listing_pages")
+        print("new previous length",previous_length,"new urls",len(new_urls))
+        
+        # once loading more articles doesn't turn up any new URLs, or only URLs that are
+        # already in the database, we've caught up with the previous crawl and can stop
+        if len([u for u in new_urls if u not in old_urls]) == 0:
+            print("no new articles, moving on")
+            break
+        
+        # find the load more button
+        # if it is possible to click on the button, keep the loop going
+        # and add as many URLs as possible
+        # if clicking the button fails, or no articles show up after clicking,
+        # break and move to the next section
+        try:
+            driver.find_element_by_css_selector("div.load-more").click()
+            print("click successful")
+        except:
+            print("click failed")
+            break
+        
+        if not wait_for_articles(driver, previous_length):
+            print("no articles loaded")
+            break
+
+def wait_for_articles(driver, previous_length):
+    # poll the number of articles in the list until more show up or we time out
+    deadline = time.monotonic() + LOAD_MORE_TIMEOUT
+    while time.monotonic() < deadline:
+        if driver.execute_script(FOX_ARTICLE_COUNT_SCRIPT) > previous_length:
+            return True
+        time.sleep(0.25)
+    return False
+
+def create_driver():
+    # a window-less Chrome browser
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless')
+    options.add_argument('--window-size=1920,1080')
+    return webdriver.Chrome(options=options)
+
+def training_split(n):
+    # a list of indices corresponding to the number of articles is randomly shuffled
+    # the article's index in the original list is used to grab the number randomly assigned 
+    # to that index, if that number was greater than 80% of the list's size 
+    # it is a test article (0), otherwise a training one (1)
+    randomList = np.arange(0,n)
+    random.shuffle(randomList)
+    
+    return [int(randomList[i] < round(n*.8)) for i in range(n)]
+
+class HostRateLimiter:
+    # makes sure requests to the same host are at least delay seconds apart,
+    # no matter how many threads are fetching from it
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.next_time = {}
+    
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time.get(host, now))
+            self.next_time[host] = start + self.delay
+        
+        if start > now:
+            time.sleep(start - now)
+
+class PageFetcher:
+    # fetches pages on a pool of worker threads, either with plain HTTP requests or
+    # with one headless browser per thread for pages that need JavaScript
+    def __init__(self, workers, use_browser, delay, retries):
+        self.workers = workers
+        self.use_browser = use_browser
+        self.retries = retries
+        self.limiter = HostRateLimiter(delay)
+        self.local = threading.local()
+        self.drivers = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+    
+    def get_driver(self):
+        # each thread lazily creates its own browser the first time it needs one
+        driver = getattr(self.local, "driver", None)
+        if driver is None:
+            driver = create_driver()
+            self.local.driver = driver
+            with self.lock:
+                self.drivers.append(driver)
+        return driver
+    
+    def discard_driver(self):
+        # a browser that failed a request may be stuck, so it is replaced on the next request
+        driver = getattr(self.local, "driver", None)
+        if driver is not None:
+            self.local.driver = None
+            with self.lock:
+                self.drivers.remove(driver)
+            try:
+                driver.quit()
+            except Exception:
+                pass
+    
+    def get(self, url):
+        if self.use_browser:
+            driver = self.get_driver()
+            driver.get(url)
+            return driver.page_source
         
-        # the article's index in the original list is used to grab the number randomly assigned 
-        # to that index, if that number was greater than 80% of the list's size 
-        # it is a test article, otherwise a training one
-        for i, a in enumerate(site_dict[site]["articles"]):
-            train = 1
-            if(randomList[i] >= round(len(site_dict[site]["articles"])*.8)):
-                train = 0
-                
-            a.is_training = train
-            session.add(a)
-    
-    # once all articles are added to the session, commit the changes to the database    
-    session.commit()
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            charset = response.headers.get_content_charset() or "utf-8"
+            return response.read().decode(charset, errors="replace")
+    
+    def fetch_one(self, url):
+        # retry failed requests with an exponential backoff before giving up
+        # the fetch stage runs on the worker threads, so its time adds up across all of them
+        # once the crawl is stopping, requests that haven't started yet are given up on
+        for attempt in range(self.retries+1):
+            self.limiter.wait(url)
+            if self.stopping.is_set():
+                return None
+            try:
+                with metrics.stage("fetch"):
+                    html = self.get(url)
+                    metrics.add("pages_fetched")
+                    metrics.add("bytes_fetched", len(html))
+                return html
+            except Exception as e:
+                print("Attempt",attempt+1,"failed for",url,":",e)
+                metrics.add("failed_requests")
+                if self.use_browser:
+                    self.discard_driver()
+                if attempt == self.retries:
+                    return None
+                time.sleep(2**attempt)
+    
+    def fetch(self, jobs):
+        # jobs is a list of (key, url) pairs, the (key, html) pairs are yielded in the order
+        # they finish, with None as the html if every attempt failed
+        # only a window of twice as many jobs as threads is submitted at a time, and each page
+        # is let go of once it's yielded, so memory doesn't grow with the size of the crawl
+        # if the loop over the pages stops early, the jobs that haven't started are cancelled
+        # and only the requests already running are waited for
+        jobs = iter(jobs)
+        window = self.workers*2
+        self.stopping.clear()
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures = {pool.submit(self.fetch_one, url): key for key, url in islice(jobs, window)}
+            while len(futures) > 0:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = futures.pop(future)
+                    for next_key, url in islice(jobs, 1):
+                        futures[pool.submit(self.fetch_one, url)] = next_key
+                    yield key, future.result()
+        finally:
+            self.stopping.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+    
+    def close(self):
+        # fetch waits for its threads before returning, so no browser is still in use here
+        with self.lock:
+            drivers = list(self.drivers)
+            self.drivers = []
+        for driver in drivers:
+            driver.quit()
 
 def extract_text(site, soup):
     # each site has a different way of representing the text of the article
@@ -187,48 +560,21 @@ def extract_text(site, soup):
         
     return article_text    
     
-def process_text(proc):
-    #in case the text has this character, make sure it's replaced with a space 
-    #so word boundaries are respected
-    proc = proc.replace("\xa0"," ")
-    
-    #some articles have 2 letter abbreviations separated with periods (a.m., U.S.)
-    #this finds them and removes the periods so they can be considered as n-grams
-    #there is likely a better way of doing this but I tried
-    match = re.findall(r'[A-Za-z]\.[A-Za-z]\.',proc)
-    if(len(match)>0):
-        for m in match:
-            proc = proc.replace(m, m.replace('.',''))
-            
-    #This removes periods from acronyms longer than 2 characters
-    proc = re.sub(r'(?<!\w)([A-Z])\.', '',proc)
-            
-    #This removes numbers and special characters except periods, colons, question marks and spaces
-    proc = re.sub('[^A-Za-z.?: ]+', '', proc)
-    
-    #There is probably a more elegant way of doing this, but this ensures that sentence
-    #boundaries are respected by putting in a space instead (otherwise the words combine)
-    #However this operation can introduce extra whitespace which needs to be removed as well
-    proc = re.sub(r'[.?:]+', " ",proc)
-    proc = re.sub("\s\s+" , " ", proc)
-    proc = proc.strip()
-    
-    #now we convert all the words or ngrams to lower case, unless the ngram is an acronym
-    #then we know it is a different ngram and should be stored in upper case
-    newProc = []
-    for s in proc.split(" "):
-        if(s == s.upper() and len(s) > 1 and len(s) < 6):
-            newProc.append(s)
-        else:
-            newProc.append(s.lower())
-    proc = " ".join(newProc)
-    
-    return proc
-
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape political news articles and add them to the database")
+    parser.add_argument("--replay", action="store_true",
+                        help="re-extract the text of every archived page instead of crawling "
+                             "(run data-processing.py --rebuild afterwards if any text changed)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    
     # wrap the program in a try/except block in case there are errors
+    # the metrics and profile are written even if the run fails part way through
+    metrics.start(profile=args.profile is not None, trace_memory=args.trace_memory)
     try:
-        main()
+        main(replay=args.replay)
     except Exception as e:
         print(e)
-        print(traceback.format_exc())
\ No newline at end of file
+        print(traceback.format_exc())
+    finally:
+        metrics.finish(args.metrics, args.profile)
\ No newline at end of file